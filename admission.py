@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict, deque
+import metrics
+from config import Configuration
+
+# admission control: what a server process takes on when a lot of clients arrive at once
+# new connections are checked against connection caps and token buckets before they get a thread, and
+# USR commands against their own buckets; logins beyond the ones being checked wait their turn in a
+# bounded FIFO instead of all piling onto the database locks at once
+
+REFUSED = metrics.counter("msn_connections_refused_total", "Connections closed at accept by admission control", ["reason"])
+LOGINS_SHED = metrics.counter("msn_logins_shed_total", "USR commands answered with a busy error instead of being handled", ["reason"])
+LOGINS_WAITING = metrics.gauge("msn_logins_waiting", "Logins queued behind the ones being checked")
+LOGIN_WAIT_SECONDS = metrics.histogram("msn_login_wait_seconds", "Time a USR command waited for its turn")
+
+class TokenBucket():
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+    def __init__(self, rate, burst, now):
+        self.rate = rate # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class RateLimit():
+    # one bucket shared by every client and one per client address; a rate of None disables that bucket
+    def __init__(self, rate, burst, address_rate, address_burst, addresses=Configuration.admission_addresses):
+        self.shared = None if rate is None else TokenBucket(rate, burst, time.monotonic())
+        self.address_rate = address_rate
+        self.address_burst = address_burst
+        self.addresses = addresses
+        self.buckets = OrderedDict() # address -> TokenBucket, least recently seen first
+        self.lock = threading.Lock()
+
+    def allow(self, address):
+        # returns None if {address} may go ahead, otherwise the reason it may not
+        now = time.monotonic()
+        with self.lock:
+            if self.address_rate is not None:
+                bucket = self.buckets.get(address)
+                if bucket is None:
+                    bucket = self.buckets[address] = TokenBucket(self.address_rate, self.address_burst, now)
+                    if len(self.buckets) > self.addresses:
+                        self.buckets.popitem(last=False)
+                else:
+                    self.buckets.move_to_end(address)
+                if not bucket.take(now):
+                    return "address_rate"
+            if self.shared is not None and not self.shared.take(now):
+                return "rate"
+        return None
+
+class ConnectionAdmission():
+    # checked by the accept loop, so a refused connection costs a close and nothing else
+    def __init__(self, limit=Configuration.max_connections, address_limit=Configuration.max_connections_per_address):
+        self.limit = limit
+        self.address_limit = address_limit
+        self.rate = RateLimit(Configuration.connect_rate, Configuration.connect_burst,
+            Configuration.connect_rate_per_address, Configuration.connect_burst_per_address)
+        self.open = {} # address -> connections open from it
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def admit(self, address):
+        # returns True and counts the connection if it may be served; every admitted connection is released once
+        with self.lock:
+            if self.limit is not None and self.total >= self.limit:
+                reason = "connections"
+            elif self.address_limit is not None and self.open.get(address, 0) >= self.address_limit:
+                reason = "address_connections"
+            else:
+                reason = self.rate.allow(address)
+            if reason is None:
+                self.total += 1
+                self.open[address] = self.open.get(address, 0) + 1
+                return True
+        REFUSED.labels(reason).inc()
+        return False
+
+    def release(self, address):
+        with self.lock:
+            self.total -= 1
+            count = self.open[address] - 1
+            if count:
+                self.open[address] = count
+            else:
+                del self.open[address]
+
+class LoginQueue():
+    # at most {concurrency} logins are handled at once and the rest are let in in arrival order
+    # in asyncio mode handlers already run one at a time on the loop, so only the rate limits apply there
+    def __init__(self, concurrency=Configuration.login_concurrency, size=Configuration.login_queue_size, timeout=Configuration.login_queue_timeout):
+        self.concurrency = concurrency
+        self.size = size
+        self.timeout = timeout
+        self.rate = RateLimit(Configuration.usr_rate, Configuration.usr_burst,
+            Configuration.usr_rate_per_address, Configuration.usr_burst_per_address)
+        self.active = 0
+        self.waiting = deque() # an Event per queued login, oldest first
+        self.lock = threading.Lock()
+
+    def enter(self, address):
+        # returns None once the caller may go ahead, and it must then call leave(); otherwise the reason it was shed
+        reason = self.rate.allow(address)
+        if reason is not None:
+            LOGINS_SHED.labels(reason).inc()
+            return reason
+        with self.lock:
+            if self.active < self.concurrency and not self.waiting:
+                self.active += 1
+                return None
+            if len(self.waiting) >= self.size:
+                LOGINS_SHED.labels("queue_full").inc()
+                return "queue_full"
+            turn = threading.Event()
+            self.waiting.append(turn)
+        LOGINS_WAITING.inc()
+        start = time.perf_counter()
+        admitted = turn.wait(self.timeout)
+        LOGINS_WAITING.dec()
+        LOGIN_WAIT_SECONDS.observe(time.perf_counter() - start)
+        if not admitted:
+            with self.lock:
+                # leave() may have handed over a slot just as the wait gave up
+                if not turn.is_set():
+                    self.waiting.remove(turn)
+                    LOGINS_SHED.labels("queue_timeout").inc()
+                    return "queue_timeout"
+        return None
+
+    def leave(self):
+        with self.lock:
+            if self.waiting:
+                # the slot passes straight to the oldest waiter, so nobody can overtake the queue
+                self.waiting.popleft().set()
+            else:
+                self.active -= 1
+
+LOGINS = LoginQueue()
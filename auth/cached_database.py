@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+import metrics
+from config import Configuration
+
+# read-through cache in front of any UserDatabase for the lookups the hot paths repeat:
+# nicknames, contact info and contact lists
+# every entry is tagged with the users whose data it was built from: ("nick", user) for a nickname it shows,
+# ("lists", user) for that user's lists and contacts; a write made through the cache drops the entries tagged
+# with what it changed. contact lists are also keyed by the user's list version, so a list change made by another
+# process (e.g. another worker on the same SQLite file) is seen at once; other entries expire after {ttl} seconds,
+# which bounds how long such a write can go unseen
+# everything else, writes included, is passed straight to the wrapped database
+
+CACHE_REQUESTS = metrics.counter("msn_user_cache_requests_total", "User database lookups answered from the cache (hit) or the database (miss)", ["kind", "result"])
+CACHE_EVICTIONS = metrics.counter("msn_user_cache_evictions_total", "Cache entries dropped to stay within the size limit")
+CACHE_INVALIDATIONS = metrics.counter("msn_user_cache_invalidations_total", "Cache entries dropped because a write changed what they were built from")
+
+KINDS = ("nickname", "contact", "list")
+HITS = {kind: CACHE_REQUESTS.labels(kind, "hit") for kind in KINDS}
+MISSES = {kind: CACHE_REQUESTS.labels(kind, "miss") for kind in KINDS}
+
+class CachedUserDatabase():
+    def __init__(self, backend, size=Configuration.user_cache_size, ttl=Configuration.user_cache_ttl):
+        self.backend = backend
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (value, expiry, tags), least recently used first
+        self.tagged = {} # tag -> keys of the entries built from it
+        # bumped by every invalidation; a lookup that raced one does not store what it read
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def __lookup__(self, kind, key, load):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                HITS[kind].inc()
+                return entry[0]
+            generation = self.generation
+        MISSES[kind].inc()
+        value, tags = load()
+        with self.lock:
+            if self.generation == generation:
+                self.__store__(key, value, now + self.ttl, tags)
+        return value
+
+    def __store__(self, key, value, expiry, tags):
+        self.__drop__(key)
+        self.entries[key] = (value, expiry, tags)
+        for tag in tags:
+            self.tagged.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.size:
+            self.__drop__(next(iter(self.entries)))
+            CACHE_EVICTIONS.inc()
+
+    def __drop__(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+    def __invalidate__(self, *tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self.tagged.pop(tag, ()):
+                    self.__drop__(key)
+                    CACHE_INVALIDATIONS.inc()
+
+    def get_nickname(self, username):
+        return self.__lookup__("nickname", ("nickname", username),
+            lambda: (self.backend.get_nickname(username), (("nick", username),)))
+
+    def get_contact_info(self, username, contact_name):
+        return self.__lookup__("contact", ("contact", username, contact_name),
+            lambda: (self.backend.get_contact_info(username, contact_name), (("lists", username), ("nick", contact_name))))
+
+    def get_contacts_from_list(self, username, list_pos):
+        def load():
+            contacts = tuple(self.backend.get_contacts_from_list(username, list_pos))
+            return contacts, (("lists", username), *(("nick", c.username) for c in contacts))
+        # keyed by the list version, which is read from the database every time: a list change made by another
+        # process bumps it, so a SYN never sends a version together with lists older than it
+        version = self.backend.get_list_version(username)
+        # callers get their own list; the Contact objects in it are shared and must not be changed
+        return list(self.__lookup__("list", ("list", username, list_pos, version), load))
+
+    # writes: the wrapped database first, then everything built from what it changed
+
+    def remove_user(self, username):
+        try:
+            return self.backend.remove_user(username)
+        finally:
+            self.__invalidate__(("nick", username), ("lists", username))
+
+    def set_nickname(self, username, nickname):
+        try:
+            return self.backend.set_nickname(username, nickname)
+        finally:
+            self.__invalidate__(("nick", username))
+
+    def add_contact_to_list(self, username, contact_name, list_num):
+        # a forward list change also changes the contact's reverse list
+        try:
+            return self.backend.add_contact_to_list(username, contact_name, list_num)
+        finally:
+            self.__invalidate__(("lists", username), ("lists", contact_name))
+
+    def remove_contact_from_list(self, username, contact_name, list_num):
+        try:
+            return self.backend.remove_contact_from_list(username, contact_name, list_num)
+        finally:
+            self.__invalidate__(("lists", username), ("lists", contact_name))
+
+    def add_to_group(self, username, groupnum, contact):
+        try:
+            return self.backend.add_to_group(username, groupnum, contact)
+        finally:
+            self.__invalidate__(("lists", username))
+
+    def remove_from_group(self, username, groupnum, contact):
+        try:
+            return self.backend.remove_from_group(username, groupnum, contact)
+        finally:
+            self.__invalidate__(("lists", username))
+
+    def del_group(self, username, groupnum):
+        try:
+            return self.backend.del_group(username, groupnum)
+        finally:
+            self.__invalidate__(("lists", username))
@@ -6,5 +6,13 @@ USER_ALREADY_IN_LIST = 215
 USER_NOT_IN_LIST = 216
 USER_OFFLINE = 217
 USER_IN_ALLOW_AND_BLOCK = 219
+INVALID_GROUP = 224
+USER_NOT_IN_GROUP = 225
+GROUP_ALREADY_EXISTS = 228
+CANNOT_REMOVE_GROUP_ZERO = 230
+NOT_EXPECTED = 715
+SERVER_BUSY = 600
+SERVER_UNAVAILABLE = 601
+SERVER_TOO_BUSY = 910
 
 SUCCESS = 0
\ No newline at end of file
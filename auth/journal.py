@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+import time
+from config import Configuration
+from process_local import ProcessLocal
+
+class Journal(ProcessLocal):
+    # append-only log of per-user changes on top of a JSON snapshot (see auth/snapshot.py for the binary one)
+    # each record is [username, entry] where entry is the user's full database entry, or None if removed
+    # mutations only mark a user dirty; a background flusher coalesces them into one write per batch
+    # the files belong to one process: the one that loaded them, or the one that claim()s them after a fork;
+    # a forked copy of the database in any other process is read-only, so stale copies never compact
+    def __init__(self, snapshot_file, freeze, dump, entry, exclude_writers,
+                 compact_after=Configuration.journal_compact_after, compact_interval=Configuration.journal_compact_interval,
+                 flush_interval=Configuration.journal_flush_interval, flush_batch=Configuration.journal_flush_batch,
+                 fsync=Configuration.journal_fsync, fsync_interval=Configuration.journal_fsync_interval):
+        self.snapshot_file = snapshot_file
+        self.journal_file = f"{snapshot_file}.journal"
+        self.old_journal_file = f"{snapshot_file}.journal.old"
+        self.freeze = freeze # called with writers excluded; returns a copy of the database later writes cannot change
+        # (writers that change nested containers in place must copy them instead while {compacting} is set)
+        self.dump = dump # returns what freeze() returned as a JSON string; runs with writers let back in
+        self.entry = entry # returns the serialisable entry for one username, or None if removed
+        self.exclude_writers = exclude_writers # returns a context manager that keeps writers out
+        self.compact_after = compact_after
+        self.compact_interval = compact_interval
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.file_lock = threading.Lock()
+        self.dirty = {} # usernames changed since the last flush, in order
+        self.records = 0
+        self.unsynced = False
+        self.last_fsync = time.monotonic()
+        self.last_compaction = time.monotonic()
+        self.file = None
+        self.wakeup = threading.Event()
+        self.running = False
+        self.compacting = False # a frozen copy is being serialised outside the writer lock
+        self.owner = None # pid of the process that writes the files
+        self.flusher = None
+
+    def load(self):
+        database = self.read_snapshot()
+        # a crash mid-compaction leaves the rotated journal behind; its records are idempotent
+        for journal_file in [self.old_journal_file, self.journal_file]:
+            self.records += self.replay(journal_file, database)
+        if os.path.exists(self.old_journal_file):
+            # finish the interrupted compaction before the old journal can be overwritten
+            self.write_snapshot(self.serialise(database))
+            os.remove(self.old_journal_file)
+        self.file = open(self.journal_file, 'a')
+        self.running = True
+        self.owner = os.getpid()
+        return database
+
+    def claim(self):
+        # hands the files to the calling process; the database must not be written to before the fork
+        self.owner = os.getpid()
+
+    def owned(self):
+        return self.owner == os.getpid()
+
+    def ensure_started(self):
+        # the flusher is started lazily by the first write in the owning process
+        if not self.owned():
+            raise RuntimeError(f"{self.journal_file} is written by process {self.owner}; the database is read-only here")
+        super().ensure_started()
+
+    def start_process(self):
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def read_snapshot(self):
+        with open(self.snapshot_file, 'r') as f:
+            return json.load(f)
+
+    def serialise(self, database):
+        # what write_snapshot takes, from what read_snapshot returned
+        return json.dumps(database)
+
+    def apply(self, database, username, entry):
+        if entry is None:
+            database.pop(username, None)
+        else:
+            database[username] = entry
+
+    def replay(self, journal_file, database):
+        count = 0
+        try:
+            with open(journal_file, 'r') as f:
+                for line in f:
+                    try:
+                        username, entry = json.loads(line)
+                    except ValueError:
+                        # torn final record from a crash
+                        break
+                    self.apply(database, username, entry)
+                    count += 1
+        except FileNotFoundError:
+            pass
+        return count
+
+    def mark_dirty(self, username):
+        # called with writers excluded; repeated changes to one user collapse into a single record
+        self.ensure_started()
+        self.dirty[username] = None
+        if len(self.dirty) >= self.flush_batch:
+            self.wakeup.set()
+
+    def flush(self):
+        # writes every pending change as one batch; safe to call from tests or on shutdown
+        with self.exclude_writers():
+            if not self.dirty:
+                return
+            lines = "".join(f"{json.dumps([u, self.entry(u)], separators=(',', ':'))}\n" for u in self.dirty)
+            count = len(self.dirty)
+            self.dirty = {}
+            with self.file_lock:
+                self.file.write(lines)
+                self.file.flush()
+                self.records += count
+                self.unsynced = True
+        if self.fsync == "batch":
+            self.sync()
+
+    def sync(self):
+        with self.file_lock:
+            if self.unsynced:
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+            self.last_fsync = time.monotonic()
+
+    def rotate(self):
+        with self.file_lock:
+            self.file.close()
+            os.replace(self.journal_file, self.old_journal_file)
+            self.file = open(self.journal_file, 'a')
+            self.records = 0
+            self.unsynced = False
+
+    def compact(self):
+        # writers are only held back while the database is frozen and the journal rotated, not while it is serialised
+        with self.exclude_writers():
+            self.last_compaction = time.monotonic()
+            if self.records == 0 and not self.dirty:
+                return
+            frozen = self.freeze()
+            # the snapshot already holds every pending change
+            self.dirty = {}
+            self.rotate()
+            self.compacting = True
+        try:
+            self.write_snapshot(self.encode(frozen))
+        finally:
+            self.compacting = False
+        os.remove(self.old_journal_file)
+
+    def encode(self, frozen):
+        # what write_snapshot takes, from what freeze returned
+        return self.dump(frozen)
+
+    def write_snapshot(self, data):
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+
+    def flush_loop(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            if not self.running:
+                return
+            self.flush()
+            now = time.monotonic()
+            if self.fsync == "interval" and now - self.last_fsync >= self.fsync_interval:
+                self.sync()
+            if self.records >= self.compact_after or now - self.last_compaction >= self.compact_interval:
+                self.compact()
+
+    def close(self):
+        # only the owner has anything to write; other processes just drop their copy
+        if not self.owned():
+            return
+        self.running = False
+        self.wakeup.set()
+        if self.started_here():
+            self.flusher.join()
+        self.flush()
+        self.sync()
+        self.compact()
+        with self.file_lock:
+            self.file.close()
@@ -3,27 +3,40 @@ import parse
 from msn_patcher import MSNPatcher
 import sys
 from auth.errors import *
+from admission import LOGINS
 from notification_server.synchroniser import SynchroniserFactory
 import threading
 
 class Login(MSNPatcher):
+    __slots__ = ()
     def protocol_check(self, data):
         pass
     def version_check(self, data):
+        # the newest version both sides speak decides which synchroniser the connection gets after login
         trid = data[0]
-        permitted_versions = Configuration.permitted_versions
-        self.connection.send(f"VER {trid} {permitted_versions}")
+        offered = data[1:]
+        for version in Configuration.permitted_versions.split():
+            if version in offered:
+                self.connection.protocol = version
+                self.connection.send(" ".join(["VER", trid, version, *(["CVR0"] if "CVR0" in offered else [])]))
+                return
+        self.connection.send(f"VER {trid} 0")
+        self.connection.shutdown()
 
 class MD5Login(Login):
-    def __init__(self, database, connection):
+    __slots__ = ('database', 'presence', 'synchroniser')
+    commands = {
+        "INF": "protocol_check",
+        "USR": "md5_auth",
+        "VER": "version_check"
+    }
+
+    def __init__(self, database, presence, synchroniser, connection):
         super().__init__(connection)
         self.database = database
-        self.func_table = {
-            "INF": self.protocol_check,
-            "USR": self.md5_auth,
-            "VER": self.version_check
-        }
-        
+        self.presence = presence
+        self.synchroniser = synchroniser
+
     def protocol_check(self, data):
         trid = data.pop(0)
         self.connection.send(f"INF {trid} MD5")
@@ -35,33 +48,58 @@ class MD5Login(Login):
             sys.stderr.write(f"Non-MD5 login attempted from {self.connection.client_address}")
             return
         key = data[3]
-        match data[2]:
-            case 'I':
-                self.send_md5_salt(key, trid)
-            case 'S':
-                self.check_md5_response(key, trid)
-            case _:
-                sys.stderr.write(f"Malformed login from {self.connection.client_address}")
-                return
+        # every USR goes through admission control, so a login storm is worked through in order
+        shed = LOGINS.enter(self.connection.client_address[0])
+        if shed is not None:
+            self.connection.error(SERVER_TOO_BUSY if shed.endswith("rate") else SERVER_BUSY, trid)
+            return
+        try:
+            match data[2]:
+                case 'I':
+                    self.send_md5_salt(key, trid)
+                case 'S':
+                    self.check_md5_response(key, trid)
+                case _:
+                    sys.stderr.write(f"Malformed login from {self.connection.client_address}")
+                    return
+        finally:
+            LOGINS.leave()
         
     def check_md5_response(self, key, trid):
+        if self.connection.username is None:
+            # no challenge was sent: USR I was shed, named an unknown user, or never came
+            self.connection.error(INVALID_CREDENTIALS, trid)
+            self.connection.shutdown()
+            return
         if self.database.check_response(self.connection.username, key):
             self.connection.send(f"USR {trid} OK {self.connection.username} {self.connection.username}")
             self.database.set_connection_for_user(self.connection, self.connection.username)
-            self.connection.add_patcher(SynchroniserFactory(self.database))
+            self.connection.add_patcher(self.synchroniser)
         else:
             self.connection.error(INVALID_CREDENTIALS, trid)
 
     def send_md5_salt(self, username, trid):
-        self.connection.username = username
         if self.database.check_username(username):
+            self.connection.username = username
             salt = self.database.get_salt(username)
             self.connection.send(f"USR {trid} MD5 S {salt}")
         else:
+            self.connection.username = None
             self.connection.error(INVALID_CREDENTIALS, trid)
 
 class MD5LoginFactory():
-    def __init__(self, database):
+    def __init__(self, database, presence):
         self.database = database
+        self.presence = presence
+        self.synchroniser = SynchroniserFactory(database, presence)
+    def start(self):
+        # logins, list and nickname changes are all served here, so this process writes the database
+        self.database.own()
+        # fills this process's directory replica before the first CHG looks contacts up in it
+        if self.database.directory is not None:
+            self.database.directory.connect()
+    def stop(self):
+        # pending journal records are written and synced before the process exits
+        self.database.close()
     def __call__(self, connection):
-        return MD5Login(self.database, connection)
+        return MD5Login(self.database, self.presence, self.synchroniser, connection)
@@ -0,0 +1,40 @@
+import argparse
+import json
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auth.user_database import MD5JSON, MD5Snapshot, MD5SQLite
+from auth.snapshot import write_snapshot
+
+def open_source(path):
+    # JSON or binary snapshot, with its journal replayed
+    if path.endswith(".snap"):
+        return MD5Snapshot(path)
+    return MD5JSON(path)
+
+def migrate(source_file, destination_file):
+    # copies every user from an MD5JSON or MD5Snapshot database into a new database of the kind
+    # {destination_file}'s extension selects: .db/.sqlite/.sqlite3, .snap or JSON
+    source = open_source(source_file)
+    users = {username: source.__encode__(entry) for username, entry in list(source.database.items())}
+    if destination_file.endswith((".db", ".sqlite", ".sqlite3")):
+        destination = MD5SQLite(destination_file)
+        for username, entry in users.items():
+            destination.import_user(username, entry)
+    elif destination_file.endswith(".snap"):
+        write_snapshot(destination_file, users)
+    else:
+        with open(destination_file, 'w') as f:
+            json.dump(users, f)
+    return len(users)
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a JSON or snapshot user database to SQLite, a snapshot or JSON")
+    parser.add_argument("source_file")
+    parser.add_argument("destination_file")
+    args = parser.parse_args()
+    count = migrate(args.source_file, args.destination_file)
+    print(f"migrated {count} users from {args.source_file} to {args.destination_file}")
+
+if __name__ == "__main__":
+    main()
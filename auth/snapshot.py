@@ -0,0 +1,273 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+import metrics
+from auth.journal import Journal
+
+# binary user snapshot: a header, one record per user and an index sorted by a hash of the username
+#   header: MAGIC, user count (u64), index offset (u64)
+#   record: username length (u16), username, the user's entry as compact JSON
+#   index:  per user, hash (u64), record offset (u64), record length (u32)
+# the file is mapped rather than read, so opening it costs the same for ten users as for a million;
+# a user is found by binary search over the index and only parsed when first asked for
+
+MAGIC = b"MSNSNAP1"
+HEADER = struct.Struct("<8sQQ")
+INDEX = struct.Struct("<QQI")
+NAME = struct.Struct("<H")
+
+SNAPSHOT_LOADS = metrics.counter("msn_user_snapshot_loads_total", "Users parsed from the binary snapshot")
+
+def name_hash(username):
+    # stable across processes and runs, unlike hash()
+    return int.from_bytes(hashlib.blake2b(username.encode("utf-8"), digest_size=8).digest(), "little")
+
+def encode_record(username, entry):
+    name = username.encode("utf-8")
+    return NAME.pack(len(name)) + name + json.dumps(entry, separators=(',', ':')).encode("utf-8")
+
+def write_records(f, records):
+    # records is (hash, record bytes) in hash order; {f} is a binary file positioned at its start
+    hashes = array('Q')
+    offsets = array('Q')
+    lengths = array('I')
+    f.write(HEADER.pack(MAGIC, 0, 0))
+    offset = HEADER.size
+    for h, record in records:
+        hashes.append(h)
+        offsets.append(offset)
+        lengths.append(len(record))
+        f.write(record)
+        offset += len(record)
+    for ix in range(len(hashes)):
+        f.write(INDEX.pack(hashes[ix], offsets[ix], lengths[ix]))
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, len(hashes), offset))
+    f.seek(0, os.SEEK_END)
+
+def write_snapshot(path, users):
+    # writes {users} ({username: entry as stored on disk}) as a new snapshot at {path}
+    order = sorted((name_hash(u), u) for u in users)
+    with open(path, 'wb') as f:
+        write_records(f, ((h, encode_record(u, users[u])) for h, u in order))
+
+class Snapshot():
+    # read-only view of one snapshot file; stays valid after the file is replaced by a compaction
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.index = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a user snapshot")
+
+    def entry_at(self, ix):
+        return INDEX.unpack_from(self.map, self.index + ix * INDEX.size)
+
+    def name_at(self, offset):
+        length = NAME.unpack_from(self.map, offset)[0]
+        return self.map[offset + NAME.size:offset + NAME.size + length]
+
+    def find(self, username):
+        # returns (offset, length) of {username}'s record, or None
+        h = name_hash(username)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry_at(mid)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        name = username.encode("utf-8")
+        # different names can share a hash, so check each record in the run
+        while lo < self.count:
+            entry_hash, offset, length = self.entry_at(lo)
+            if entry_hash != h:
+                return None
+            if self.name_at(offset) == name:
+                return offset, length
+            lo += 1
+        return None
+
+    def parse(self, offset, length):
+        start = offset + NAME.size + NAME.unpack_from(self.map, offset)[0]
+        return json.loads(self.map[start:offset + length])
+
+    def get(self, username):
+        # returns {username}'s entry as stored on disk, or None
+        location = self.find(username)
+        if location is None:
+            return None
+        return self.parse(*location)
+
+    def records(self):
+        # (hash, offset, length) in index order
+        for ix in range(self.count):
+            yield self.entry_at(ix)
+
+    def entries(self):
+        for _, offset, length in self.records():
+            yield self.name_at(offset).decode("utf-8"), self.parse(offset, length)
+
+class LazyUsers():
+    # the username -> entry mapping MD5JSON reads and writes, backed by a Snapshot
+    # unchanged users are parsed on first use and kept in a bounded LRU; users changed since the snapshot
+    # was written stay in memory until a compaction writes them out
+    # like MD5JSON's dict, reads take no database lock; only the LRU has its own short lock
+    def __init__(self, decode, encode, cache_size):
+        self.decode = decode
+        self.encode = encode
+        self.cache_size = cache_size
+        self.snapshot = None
+        self.changed = {} # username -> entry written since the snapshot
+        self.removed = set() # usernames removed since the snapshot
+        self.hot = OrderedDict() # username -> entry parsed from the snapshot, least recently used first
+        self.lock = threading.Lock()
+
+    def __getitem__(self, username):
+        entry = self.changed.get(username)
+        if entry is not None:
+            return entry
+        if username in self.removed:
+            raise KeyError(username)
+        with self.lock:
+            entry = self.hot.get(username)
+            if entry is not None:
+                self.hot.move_to_end(username)
+                return entry
+            snapshot = self.snapshot
+        encoded = snapshot.get(username)
+        if encoded is None:
+            raise KeyError(username)
+        entry = self.decode(encoded)
+        SNAPSHOT_LOADS.inc()
+        with self.lock:
+            # a compaction or write in the meantime may have made this copy stale
+            if self.snapshot is snapshot and username not in self.changed:
+                self.hot[username] = entry
+                if len(self.hot) > self.cache_size:
+                    self.hot.popitem(last=False)
+        return entry
+
+    def get(self, username, default=None):
+        try:
+            return self[username]
+        except KeyError:
+            return default
+
+    def __contains__(self, username):
+        if username in self.changed:
+            return True
+        if username in self.removed:
+            return False
+        return username in self.hot or self.snapshot.find(username) is not None
+
+    def __setitem__(self, username, entry):
+        # readers look in {changed} first, so it is published there before anything else moves
+        self.changed[username] = entry
+        self.removed.discard(username)
+        with self.lock:
+            self.hot.pop(username, None)
+
+    def pop(self, username, default=None):
+        self.removed.add(username)
+        entry = self.changed.pop(username, default)
+        with self.lock:
+            self.hot.pop(username, None)
+        return entry
+
+    def apply(self, username, entry):
+        # a journal record, in its on-disk form
+        if entry is None:
+            self.pop(username)
+        else:
+            self[username] = self.decode(entry)
+
+    def __len__(self):
+        added = sum(1 for u in list(self.changed) if self.snapshot.find(u) is None)
+        gone = sum(1 for u in list(self.removed) if self.snapshot.find(u) is not None)
+        return self.snapshot.count + added - gone
+
+    def items(self):
+        # every user, parsed without going through the LRU; O(n)
+        changed = dict(self.changed)
+        removed = set(self.removed)
+        for username, encoded in self.snapshot.entries():
+            if username not in changed and username not in removed:
+                yield username, self.decode(encoded)
+        yield from changed.items()
+
+    def freeze(self):
+        # taken with writers excluded; what the next snapshot will hold
+        return FrozenUsers(self.snapshot, dict(self.changed), set(self.removed), self.encode)
+
+    def adopt(self, frozen, snapshot):
+        # called with writers excluded once {snapshot} holds everything in {frozen}
+        with self.lock:
+            self.snapshot = snapshot
+            for username, entry in frozen.changed.items():
+                if self.changed.get(username) is entry:
+                    del self.changed[username]
+                    self.hot.pop(username, None)
+            for username in frozen.removed:
+                if username in self.removed:
+                    self.removed.discard(username)
+                    self.hot.pop(username, None)
+
+class FrozenUsers():
+    def __init__(self, snapshot, changed, removed, encode):
+        self.snapshot = snapshot
+        self.changed = changed
+        self.removed = removed
+        self.encode = encode
+
+    def records(self):
+        # merges the old snapshot's records, copied without parsing, with the changed users, in hash order
+        replaced = {name_hash(u) for u in self.changed} | {name_hash(u) for u in self.removed}
+        changed = sorted((name_hash(u), u) for u in self.changed)
+        ix = 0
+        for h, offset, length in self.snapshot.records():
+            while ix < len(changed) and changed[ix][0] <= h:
+                yield changed[ix][0], encode_record(changed[ix][1], self.encode(self.changed[changed[ix][1]]))
+                ix += 1
+            if h in replaced:
+                username = self.snapshot.name_at(offset).decode("utf-8")
+                if username in self.changed or username in self.removed:
+                    continue
+            yield h, self.snapshot.map[offset:offset + length]
+        for h, username in changed[ix:]:
+            yield h, encode_record(username, self.encode(self.changed[username]))
+
+class SnapshotJournal(Journal):
+    # the JSON journal on top of a binary snapshot; compaction streams the new snapshot instead of dumping a dict
+    def __init__(self, snapshot_file, users, entry, exclude_writers):
+        super().__init__(snapshot_file, users.freeze, None, entry, exclude_writers)
+        self.users = users
+
+    def read_snapshot(self):
+        self.users.snapshot = Snapshot(self.snapshot_file)
+        return self.users
+
+    def apply(self, database, username, entry):
+        database.apply(username, entry)
+
+    def serialise(self, database):
+        return database.freeze()
+
+    def encode(self, frozen):
+        # write_snapshot streams the records itself
+        return frozen
+
+    def write_snapshot(self, frozen):
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            write_records(f, frozen.records())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        with self.exclude_writers():
+            self.users.adopt(frozen, Snapshot(self.snapshot_file))
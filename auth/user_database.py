@@ -1,26 +1,63 @@
 import json
+import os
+import sqlite3
+import threading
+import time
 from abc import ABC, abstractmethod
 import hashlib
 import random
 import string
-from readerwriterlock import rwlock
 from list_numbers import ListNumbers
 from auth.errors import *
+from auth.journal import Journal
+from auth.snapshot import LazyUsers, SnapshotJournal
+from directory import RemoteConnection
+import metrics
+from config import Configuration
 
 class UserDatabase(ABC):
     DEFAULT_GROUP = "Other%20Contacts"
+    shared = False # True if several processes can change the database at once
     def __init__(self):
         self.user_threads = {}
         self.switchboard = None
-        self.user_threads_lock = rwlock.RWLockFairD()
+        self.directory = None
+        # lookups read the dict without a lock; only registration and removal are serialised
+        self.user_threads_lock = metrics.TimedLock(threading.Lock(), metrics.LOCK_WAIT.labels("connections", "write"))
+    def set_directory(self, directory):
+        # shares connection ownership with the other server processes
+        self.directory = directory
+        directory.set_resolver(self.get_local_connection)
     def set_connection_for_user(self, connection, username):
-        with self.user_threads_lock.gen_wlock():
+        with self.user_threads_lock:
             self.user_threads[username] = connection
+        if self.directory is not None:
+            self.directory.register(username, connection.status)
+    def remove_connection_for_user(self, connection, username):
+        # only forgets {connection} if it is still the one registered, not a newer login; returns True if it was
+        with self.user_threads_lock:
+            if self.user_threads.get(username) is not connection:
+                return False
+            del self.user_threads[username]
+        if self.directory is not None:
+            self.directory.unregister(username)
+        return True
+    def get_local_connection(self, username):
+        return self.user_threads.get(username)
     def get_connection_for_user(self, username):
-        with self.user_threads_lock.gen_rlock():
-            if username in self.user_threads:
-                return self.user_threads[username]
-            return None
+        # falls back to the directory for users connected to another process
+        connection = self.get_local_connection(username)
+        if connection is None and self.directory is not None:
+            statuses = self.directory.lookup([username])
+            if username in statuses:
+                return RemoteConnection(self.directory, username, statuses[username])
+        return connection
+    def own(self):
+        # called in the one process that changes the database, after the server processes have forked
+        pass
+    def close(self):
+        # called when the process that owns the database exits
+        pass
     def set_switchboard(self, switchboard):
         self.switchboard = switchboard
     def get_switchboard(self):
@@ -59,7 +96,7 @@ class UserDatabase(ABC):
         pass
     @abstractmethod
     def del_group(self, username, groupnum):
-        # removes group {groupnum} for user {username}
+        # removes group {groupnum} for user {username}; the other groups keep their numbers, as clients cache them
         # returns True if group is removed, False otherwise (e.g. does not exist)
         # the group {DEFAULT_GROUP} must not be removed
         # all contacts from {groupnum} should be moved to {DEFAULT_GROUP}
@@ -77,7 +114,7 @@ class UserDatabase(ABC):
         pass
     @abstractmethod
     def get_group_names(self, username):
-        # returns names of all groups for username in groupnum order
+        # returns names of all groups for username indexed by groupnum, None where a group was removed
         pass
     @abstractmethod
     def get_contacts(self, username):
@@ -100,6 +137,15 @@ class UserDatabase(ABC):
         # returns list of contacts for {username} in {list_pos}
         pass
     @abstractmethod
+    def get_list_version(self, username):
+        # returns the version of {username}'s contact lists, bumped by every ADD/REM/group change
+        pass
+    @abstractmethod
+    def get_list_changes(self, username, since):
+        # returns the changes after version {since} as [version, command, args...] in version order
+        # returns None if the change log no longer reaches back to {since}
+        pass
+    @abstractmethod
     def get_nickname(self, username):
         # returns nickname for username
         pass
@@ -109,6 +155,7 @@ class UserDatabase(ABC):
         pass
 
     class Contact():
+        __slots__ = ('username', 'nickname', 'groups', 'phone')
         def __init__(self, contact_dict, username, nickname):
             self.username = username
             self.nickname = nickname
@@ -130,19 +177,85 @@ class MD5UserDatabase(UserDatabase):
     def check_response(self, username, response):
         # returns True if the challenge response matches the username, False otherwise
         pass
+    def __make_key__(self, credentials):
+        salt = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+        key = hashlib.md5(f"{credentials}{salt}".encode('utf-8')).hexdigest()
+        return salt, key
 
 class MD5JSON(MD5UserDatabase):
+    # a writer copies a user's entry and swaps the new one in, so readers take no lock; writers are serialised by
+    # one reentrant lock. the lists and contacts dicts inside an entry are changed in place so ADD/REM stay O(1)
+    # on big rosters: readers copy them before iterating, and while a compaction is serialising the database
+    # writers copy them first instead
     def __init__(self, json_file):
         super().__init__()
         self.json_file = json_file
-        self.lock = rwlock.RWLockFairD()
-        # read json
-        with open(json_file, 'r') as f:
-            self.database = json.load(f)
+        self.write_lock = metrics.TimedLock(threading.RLock(), metrics.LOCK_WAIT.labels("users", "write"))
+        # read snapshot and replay changes made since it was written
+        self.journal = self.__journal__(json_file)
+        self.database = self.__load__()
+
+    def __journal__(self, json_file):
+        return Journal(json_file, self.__freeze__, self.__dump__, self.__entry__, lambda: self.write_lock)
+
+    def __load__(self):
+        return {k: self.__decode__(v) for k, v in self.journal.load().items()}
+
+    def __decode__(self, entry):
+        # in memory each list is a dict used as an insertion-ordered hash set
+        entry['lists'] = {k: dict.fromkeys(v) for k, v in entry['lists'].items()}
+        return entry
+
+    def __encode__(self, entry):
+        # on disk each list stays a JSON array
+        if entry is None:
+            return None
+        return {**entry, 'lists': {k: list(v) for k, v in entry['lists'].items()}}
+
+    def __freeze__(self):
+        # taken with writers excluded; published entries never change, so copying the dict is enough
+        return dict(self.database)
+
+    def __dump__(self, frozen):
+        return json.dumps({k: self.__encode__(v) for k, v in frozen.items()})
+
+    def __entry__(self, username):
+        return self.__encode__(self.database.get(username))
+
+    def __edit__(self, username):
+        # shallow copy for a writer; the groups and changes lists and each contact's dict are replaced, not changed
+        entry = dict(self.database[username])
+        if self.journal.compacting:
+            entry['lists'] = {k: dict(v) for k, v in entry['lists'].items()}
+            entry['contacts'] = dict(entry['contacts'])
+        return entry
+
+    def __write_back__(self, username, entry, change=None):
+        # publishes {entry} (None removes the user) in a single assignment; the journal flusher writes it later
+        # a process holding a read-only copy fails here, before anything is published
+        self.journal.ensure_started()
+        if entry is None:
+            self.database.pop(username, None)
+        else:
+            if change is not None:
+                self.__log_change__(entry, change)
+            self.database[username] = entry
+        self.journal.mark_dirty(username)
+
+    def __log_change__(self, entry, change):
+        # entries written before list versions were tracked start at 1 so clients at 0 get a full list
+        entry['list_ver'] = entry.get('list_ver', 1) + 1
+        changes = entry.get('changes', []) + [[entry['list_ver'], *change]]
+        entry['changes'] = changes[-Configuration.list_change_log_size:]
+
+    def own(self):
+        self.journal.claim()
 
-    def __write_back__(self):
-        with open(self.json_file, 'w') as f:
-            json.dump(self.database, f)
+    def flush(self):
+        self.journal.flush()
+
+    def close(self):
+        self.journal.close()
 
     def __get_defaults__(self, name):
         return {
@@ -151,185 +264,532 @@ class MD5JSON(MD5UserDatabase):
         }
 
     def check_username(self, username):
-        with self.lock.gen_rlock():
-            return username in self.database
+        return username in self.database
     
     def add_user(self, username, credentials, nickname=None):
         if nickname is None:
             nickname = username
-        salt = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-        key = hashlib.md5(f"{credentials}{salt}".encode('utf-8')).hexdigest()
-        with self.lock.gen_rlock():
+        salt, key = self.__make_key__(credentials)
+        with self.write_lock:
             if self.check_username(username):
                 return False
-            with self.lock.gen_wlock():
-                self.database[username] = {
-                    "nickname": nickname,
-                    "salt": salt, 
-                    "key": key,
-                    "groups": [UserDatabase.DEFAULT_GROUP],
-                    "lists": {
-                        "FL": [ # forward list
-                            # "name@server.com"
-                        ],
-                        "AL": [ # allow list
-
-                        ],
-                        "BL": [ # block list
-
-                        ],
-                        "RL": [ # reverse list
-                        
-                        ]
+            self.__write_back__(username, {
+                "list_ver": 0,
+                "changes": [
+                    # [list_ver, "ADD", "FL", "name@server.com"]
+                ],
+                "nickname": nickname,
+                "salt": salt, 
+                "key": key,
+                "groups": [UserDatabase.DEFAULT_GROUP],
+                "lists": {
+                    "FL": { # forward list
+                        # "name@server.com": None
+                    },
+                    "AL": { # allow list
+
+                    },
+                    "BL": { # block list
+
                     },
-                    "contacts": {
-                        # "name@server.com" : {
-                        #     "groups": [0, 1, ...],
-                        #     "phone": None
-                        # }
+                    "RL": { # reverse list
+
                     }
+                },
+                "contacts": {
+                    # "name@server.com" : {
+                    #     "groups": [0, 1, ...],
+                    #     "phone": None
+                    # }
                 }
-                self.__write_back__()
+            })
         return True
     
     def remove_user(self, username):
-        with self.lock.gen_rlock():
+        with self.write_lock:
             if self.check_username(username):
-                with self.lock.gen_wlock():
-                    self.database.pop(username)
-                    self.__write_back__()
+                self.__write_back__(username, None)
                 return True
         return False
     
     def get_salt(self, username):
-        with self.lock.gen_rlock():
-            return self.database[username]['salt']
+        return self.database[username]['salt']
 
     def check_response(self, username, response):
-        with self.lock.gen_rlock():
-            return self.database[username]['key'].lower() == response.lower()
+        return self.database[username]['key'].lower() == response.lower()
 
     def get_phone_number(self, username):
-        with self.lock.gen_rlock():
-            if 'phone' in self.database[username]:
-                return self.database[username]['phone']
-            return None
+        return self.database[username].get('phone')
 
     def set_phone_number(self, username, number):
-        with self.lock.gen_wlock():
+        with self.write_lock:
+            entry = self.__edit__(username)
             if number is None:
-                self.database[username].pop('phone', None)
+                entry.pop('phone', None)
             else:
-                self.database[username]['phone'] = number
-            self.__write_back__()
+                entry['phone'] = number
+            self.__write_back__(username, entry)
 
     def get_group_names(self, username):
-        with self.lock.gen_rlock():
-            return self.database[username]['groups']
+        return self.database[username]['groups']
+
+    def __has_group__(self, entry, groupnum):
+        return 0 <= groupnum < len(entry['groups']) and entry['groups'][groupnum] is not None
 
     def get_contacts(self, username):
-        with self.lock.gen_rlock():
-            return [self.get_contact_info(username, k) for k in self.database[username]['contacts']]
+        entry = self.database[username]
+        return [self.__contact__(entry, k) for k in list(entry['contacts'])]
 
     def get_nickname(self, username):
-        with self.lock.gen_rlock():
-            return self.database[username]['nickname']
+        return self.database[username]['nickname']
+
+    def get_list_version(self, username):
+        return self.database[username].get('list_ver', 1)
+
+    def get_list_changes(self, username, since):
+        entry = self.database[username]
+        changes = entry.get('changes', [])
+        oldest = changes[0][0] if changes else entry.get('list_ver', 1) + 1
+        if since < oldest - 1:
+            return None
+        return [c for c in changes if c[0] > since]
     
     def set_nickname(self, username, nickname):
-        with self.lock.gen_wlock():
-            self.database[username]['nickname'] = nickname
-            self.__write_back__()
+        with self.write_lock:
+            entry = self.__edit__(username)
+            entry['nickname'] = nickname
+            self.__write_back__(username, entry)
+
+    def __contact__(self, entry, contact_name):
+        return self.Contact(entry['contacts'][contact_name], contact_name, self.database[contact_name]['nickname'])
 
     def get_contact_info(self, username, contact_name):
-        with self.lock.gen_rlock():
-            return self.Contact(self.database[username]['contacts'][contact_name], contact_name, self.database[contact_name]['nickname']) 
+        return self.__contact__(self.database[username], contact_name)
 
     def get_contacts_from_list(self, username, list_pos):
-        with self.lock.gen_rlock():
-            return [self.get_contact_info(username, k) for k in self.database[username]["lists"][list_pos]]
+        entry = self.database[username]
+        return [self.__contact__(entry, k) for k in list(entry['lists'][list_pos])]
 
     def new_group(self, username, groupname):
-        with self.lock.gen_rlock():
-            if groupname not in self.database[username]['groups']:
-                with self.lock.gen_wlock():
-                    self.database[username]['groups'].append([groupname])
-                    self.__write_back__()
-                return len(self.database[username]['groups']) - 1
-            return None
+        with self.write_lock:
+            entry = self.__edit__(username)
+            if groupname in entry['groups']:
+                return None
+            entry['groups'] = entry['groups'] + [groupname]
+            groupnum = len(entry['groups']) - 1
+            self.__write_back__(username, entry, ["ADG", groupname, groupnum])
+            return groupnum
     
     def add_contact_to_list(self, username, contact_name, list_num):
-        with self.lock.gen_rlock():
-            if contact_name in self.database:
-                if contact_name in self.database[username]['lists'][list_num]:
-                    return USER_ALREADY_IN_LIST
-                if list_num == ListNumbers.ALLOW_LIST and contact_name in self.database[username]['lists'][ListNumbers.BLOCK_LIST]:
-                    return USER_IN_ALLOW_AND_BLOCK
-                if list_num == ListNumbers.BLOCK_LIST and contact_name in self.database[username]['lists'][ListNumbers.ALLOW_LIST]:
-                    return USER_IN_ALLOW_AND_BLOCK
-                with self.lock.gen_wlock():
-                    if contact_name not in self.get_contacts(username):
-                        self.database[username]['contacts'][contact_name] = self.__get_defaults__(contact_name)
-                    self.database[username]['lists'][list_num].append(contact_name)
-                    self.__write_back__()
-                if list_num == ListNumbers.FORWARD_LIST:
-                    self.add_contact_to_list(contact_name, username, ListNumbers.REVERSE_LIST)
-                return SUCCESS
-            #FIXME: refactor to remove hardcoded signal.com
-            if contact_name.split('@')[1] == 'signal.com':
+        with self.write_lock:
+            if contact_name not in self.database:
+                #FIXME: refactor to remove hardcoded signal.com
+                if contact_name.split('@')[1] != 'signal.com':
+                    return NONEXISTENT_EMAIL
                 self.add_user(contact_name, "")
-                return self.add_contact_to_list(username, contact_name, list_num)
-        return NONEXISTENT_EMAIL
+            entry = self.__edit__(username)
+            lists = entry['lists']
+            if contact_name in lists[list_num]:
+                return USER_ALREADY_IN_LIST
+            if list_num == ListNumbers.ALLOW_LIST and contact_name in lists[ListNumbers.BLOCK_LIST]:
+                return USER_IN_ALLOW_AND_BLOCK
+            if list_num == ListNumbers.BLOCK_LIST and contact_name in lists[ListNumbers.ALLOW_LIST]:
+                return USER_IN_ALLOW_AND_BLOCK
+            # the contact goes in before the list entry, so a reader that finds it on a list can look it up
+            if contact_name not in entry['contacts']:
+                entry['contacts'][contact_name] = self.__get_defaults__(contact_name)
+            lists[list_num][contact_name] = None
+            self.__write_back__(username, entry, ["ADD", list_num, contact_name])
+            if list_num == ListNumbers.FORWARD_LIST:
+                self.add_contact_to_list(contact_name, username, ListNumbers.REVERSE_LIST)
+            return SUCCESS
 
     def remove_contact_from_list(self, username, contact_name, list_num):
-        with self.lock.gen_rlock():
-            if contact_name in self.database:
-                if contact_name not in self.database[username]['lists'][list_num]:
-                    return USER_NOT_IN_LIST
-                with self.lock.gen_wlock():
-                    self.database[username]['lists'][list_num].remove(contact_name)
-                    self.__write_back__()
-                if list_num == ListNumbers.FORWARD_LIST:
-                    self.remove_contact_from_list(contact_name, username, ListNumbers.REVERSE_LIST)
-                return SUCCESS
-        return NONEXISTENT_EMAIL     
+        with self.write_lock:
+            if contact_name not in self.database:
+                return NONEXISTENT_EMAIL
+            entry = self.__edit__(username)
+            lists = entry['lists']
+            if contact_name not in lists[list_num]:
+                return USER_NOT_IN_LIST
+            del lists[list_num][contact_name]
+            self.__write_back__(username, entry, ["REM", list_num, contact_name])
+            if list_num == ListNumbers.FORWARD_LIST:
+                self.remove_contact_from_list(contact_name, username, ListNumbers.REVERSE_LIST)
+            return SUCCESS
+
+    def __set_contact_groups__(self, entry, contact, groups):
+        entry['contacts'][contact] = {**entry['contacts'][contact], 'groups': groups}
 
     def add_to_group(self, username, groupnum, contact):
-        with self.lock.gen_rlock():
-            if groupnum < len(self.database[username]['groups']):
-                if contact in self.get_contacts(username):
-                    with self.lock.gen_wlock():
-                        self.database[username]['contacts'][contact]['groups'].append(groupnum)
-                        self.__write_back__()
-                    return True
+        with self.write_lock:
+            entry = self.__edit__(username)
+            if self.__has_group__(entry, groupnum) and contact in entry['contacts']:
+                # like SQLite's INSERT OR IGNORE, a contact already in the group is left as it is
+                if groupnum not in entry['contacts'][contact]['groups']:
+                    self.__set_contact_groups__(entry, contact, entry['contacts'][contact]['groups'] + [groupnum])
+                    self.__write_back__(username, entry, ["ADD", ListNumbers.FORWARD_LIST, contact, groupnum])
+                return True
         return False
 
     def del_group(self, username, groupnum):
         if groupnum == 0:
             return False
-        with self.lock.gen_rlock():
-            if groupnum < len(self.database[username]['groups']):
-                with self.lock.gen_wlock():
-                    self.database[username]['groups'].pop(groupnum)
-                    self.__write_back__()
+        with self.write_lock:
+            entry = self.__edit__(username)
+            if self.__has_group__(entry, groupnum):
+                # its slot is left empty so later groups keep their numbers; empty slots at the end are dropped,
+                # so the next new group gets the highest number in use plus one, as in MD5SQLite
+                groups = entry['groups'][:groupnum] + [None] + entry['groups'][groupnum + 1:]
+                while groups[-1] is None:
+                    groups.pop()
+                entry['groups'] = groups
+                # its contacts are left in the default group
+                for contact, info in list(entry['contacts'].items()):
+                    if groupnum in info['groups']:
+                        self.__set_contact_groups__(entry, contact, [g for g in info['groups'] if g != groupnum])
+                self.__write_back__(username, entry, ["RMG", groupnum])
                 return True
         return False
 
     def remove_from_group(self, username, groupnum, contact):
-        with self.lock.gen_rlock():
-            if groupnum < len(self.database[username]['groups']):
-                if contact in self.get_contacts(username):
-                    with self.lock.gen_wlock():
-                        self.database[username]['contacts'][contact]['groups'].remove(groupnum)
-                        self.__write_back__()
-                    return True
+        with self.write_lock:
+            entry = self.__edit__(username)
+            if self.__has_group__(entry, groupnum) and contact in entry['contacts'] and groupnum in entry['contacts'][contact]['groups']:
+                groups = list(entry['contacts'][contact]['groups'])
+                groups.remove(groupnum)
+                self.__set_contact_groups__(entry, contact, groups)
+                self.__write_back__(username, entry, ["REM", ListNumbers.FORWARD_LIST, contact, groupnum])
+                return True
         return False
 
     def get_usernames_by_phone_number(self, number):
         # O(n): do not use when possible
         # this is why an SQL implementation would be better
-        users = []
-        with self.lock.gen_rlock():
-            for user in self.database:
-                if user['phone'] == number:
-                    users.append(user)
-        return users
+        return [username for username, entry in list(self.database.items()) if entry.get('phone') == number]
+
+class MD5Snapshot(MD5JSON):
+    # MD5JSON over a binary snapshot (auth/snapshot.py): startup maps the file instead of parsing it,
+    # and only the users in use are held in memory
+    def __init__(self, snapshot_file, cache_size=Configuration.snapshot_cache_size):
+        self.cache_size = cache_size
+        super().__init__(snapshot_file)
+
+    def __journal__(self, snapshot_file):
+        users = LazyUsers(self.__decode__, self.__encode__, self.cache_size)
+        return SnapshotJournal(snapshot_file, users, self.__entry__, lambda: self.write_lock)
+
+    def __load__(self):
+        return self.journal.load()
+
+class MD5SQLite(MD5UserDatabase):
+    shared = True
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            nickname TEXT NOT NULL,
+            salt TEXT NOT NULL,
+            key TEXT NOT NULL,
+            phone TEXT
+        );
+        CREATE INDEX IF NOT EXISTS users_phone ON users (phone);
+        CREATE TABLE IF NOT EXISTS list_versions (
+            username TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS list_changes (
+            username TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            change TEXT NOT NULL,
+            PRIMARY KEY (username, version)
+        );
+        CREATE TABLE IF NOT EXISTS groups (
+            username TEXT NOT NULL,
+            groupnum INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (username, groupnum)
+        );
+        CREATE TABLE IF NOT EXISTS contacts (
+            username TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            phone TEXT,
+            PRIMARY KEY (username, contact)
+        );
+        CREATE TABLE IF NOT EXISTS contact_groups (
+            username TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            groupnum INTEGER NOT NULL,
+            PRIMARY KEY (username, contact, groupnum)
+        );
+        CREATE TABLE IF NOT EXISTS lists (
+            username TEXT NOT NULL,
+            list TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            PRIMARY KEY (username, list, contact)
+        );
+    """
+
+    def __init__(self, db_file):
+        super().__init__()
+        self.db_file = db_file
+        self.local = threading.local()
+        # created before the server processes fork, so this connection must not outlive it
+        db = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+        try:
+            db.executescript(self.SCHEMA)
+        finally:
+            db.close()
+
+    def __connection__(self):
+        # sqlite connections cannot be shared between threads or across a fork, so each thread of each process opens its own
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def __transaction__(self):
+        return SQLiteTransaction(self.__connection__(), "BEGIN IMMEDIATE")
+
+    def __snapshot__(self):
+        # deferred transaction: a consistent read that does not block writers under WAL
+        return SQLiteTransaction(self.__connection__(), "BEGIN")
+
+    def __query__(self, sql, *args):
+        return self.__connection__().execute(sql, args).fetchall()
+
+    # one row per group a contact is in (a NULL groupnum if none), so a whole list comes back from one query
+    CONTACTS = """
+        SELECT c.contact, c.phone, u.nickname, g.groupnum FROM contacts c
+        JOIN users u ON u.username = c.contact
+        LEFT JOIN contact_groups g ON g.username = c.username AND g.contact = c.contact
+    """
+
+    def __contacts__(self, rows):
+        contacts = {}
+        for contact_name, phone, nickname, groupnum in rows:
+            contact = contacts.get(contact_name)
+            if contact is None:
+                contact = contacts[contact_name] = self.Contact({"groups": [], "phone": phone}, contact_name, nickname)
+            if groupnum is not None:
+                contact.groups.append(groupnum)
+        return list(contacts.values())
+
+    def __in_list__(self, db, username, contact_name, list_num):
+        return db.execute("SELECT 1 FROM lists WHERE username = ? AND list = ? AND contact = ?", (username, list_num, contact_name)).fetchone() is not None
+
+    def __list_version__(self, db, username):
+        # users without a recorded version start at 1 so clients at 0 get a full list
+        row = db.execute("SELECT version FROM list_versions WHERE username = ?", (username,)).fetchone()
+        return 1 if row is None else row[0]
+
+    def __log_change__(self, db, username, change):
+        version = self.__list_version__(db, username) + 1
+        db.execute("INSERT OR REPLACE INTO list_versions (username, version) VALUES (?, ?)", (username, version))
+        db.execute("INSERT INTO list_changes (username, version, change) VALUES (?, ?, ?)", (username, version, json.dumps(change)))
+        db.execute("DELETE FROM list_changes WHERE username = ? AND version <= ?", (username, version - Configuration.list_change_log_size))
+
+    def __has_group__(self, db, username, groupnum):
+        return db.execute("SELECT 1 FROM groups WHERE username = ? AND groupnum = ?", (username, groupnum)).fetchone() is not None
+
+    def check_username(self, username):
+        return len(self.__query__("SELECT 1 FROM users WHERE username = ?", username)) > 0
+
+    def add_user(self, username, credentials, nickname=None):
+        if nickname is None:
+            nickname = username
+        salt, key = self.__make_key__(credentials)
+        with self.__transaction__() as db:
+            if db.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None:
+                return False
+            db.execute("INSERT INTO users (username, nickname, salt, key) VALUES (?, ?, ?, ?)", (username, nickname, salt, key))
+            db.execute("INSERT INTO groups (username, groupnum, name) VALUES (?, 0, ?)", (username, UserDatabase.DEFAULT_GROUP))
+            db.execute("INSERT OR REPLACE INTO list_versions (username, version) VALUES (?, 0)", (username,))
+        return True
+
+    def import_user(self, username, entry):
+        # inserts a user exactly as stored in the MD5JSON layout
+        with self.__transaction__() as db:
+            db.execute("INSERT OR REPLACE INTO users (username, nickname, salt, key, phone) VALUES (?, ?, ?, ?, ?)",
+                (username, entry['nickname'], entry['salt'], entry['key'], entry.get('phone')))
+            db.executemany("INSERT OR REPLACE INTO groups (username, groupnum, name) VALUES (?, ?, ?)",
+                [(username, ix, name) for ix, name in enumerate(entry['groups']) if name is not None])
+            for contact_name, contact in entry['contacts'].items():
+                db.execute("INSERT OR REPLACE INTO contacts (username, contact, phone) VALUES (?, ?, ?)", (username, contact_name, contact.get('phone')))
+                db.executemany("INSERT OR IGNORE INTO contact_groups (username, contact, groupnum) VALUES (?, ?, ?)",
+                    [(username, contact_name, g) for g in contact.get('groups', [])])
+            for list_num, contacts in entry['lists'].items():
+                db.executemany("INSERT OR IGNORE INTO lists (username, list, contact) VALUES (?, ?, ?)",
+                    [(username, list_num, c) for c in contacts])
+            db.execute("INSERT OR REPLACE INTO list_versions (username, version) VALUES (?, ?)", (username, entry.get('list_ver', 1)))
+            db.executemany("INSERT OR REPLACE INTO list_changes (username, version, change) VALUES (?, ?, ?)",
+                [(username, c[0], json.dumps(c[1:])) for c in entry.get('changes', [])])
+
+    def remove_user(self, username):
+        with self.__transaction__() as db:
+            if db.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount == 0:
+                return False
+            for table in ["groups", "contacts", "contact_groups", "lists", "list_versions", "list_changes"]:
+                db.execute(f"DELETE FROM {table} WHERE username = ?", (username,))
+        return True
+
+    def get_salt(self, username):
+        return self.__query__("SELECT salt FROM users WHERE username = ?", username)[0][0]
+
+    def check_response(self, username, response):
+        return self.__query__("SELECT key FROM users WHERE username = ?", username)[0][0].lower() == response.lower()
+
+    def get_phone_number(self, username):
+        return self.__query__("SELECT phone FROM users WHERE username = ?", username)[0][0]
+
+    def set_phone_number(self, username, number):
+        with self.__transaction__() as db:
+            db.execute("UPDATE users SET phone = ? WHERE username = ?", (number, username))
+
+    def get_group_names(self, username):
+        rows = self.__query__("SELECT groupnum, name FROM groups WHERE username = ? ORDER BY groupnum", username)
+        names = [None] * (rows[-1][0] + 1 if rows else 0)
+        for groupnum, name in rows:
+            names[groupnum] = name
+        return names
+
+    def get_contacts(self, username):
+        return self.__contacts__(self.__query__(f"{self.CONTACTS} WHERE c.username = ? ORDER BY c.rowid, g.rowid", username))
+
+    def get_nickname(self, username):
+        return self.__query__("SELECT nickname FROM users WHERE username = ?", username)[0][0]
+
+    def get_list_version(self, username):
+        with self.__snapshot__() as db:
+            return self.__list_version__(db, username)
+
+    def get_list_changes(self, username, since):
+        with self.__snapshot__() as db:
+            version = self.__list_version__(db, username)
+            changes = db.execute("SELECT version, change FROM list_changes WHERE username = ? AND version > ? ORDER BY version", (username, since)).fetchall()
+            oldest = db.execute("SELECT MIN(version) FROM list_changes WHERE username = ?", (username,)).fetchone()[0]
+        if oldest is None:
+            oldest = version + 1
+        if since < oldest - 1:
+            return None
+        return [[v, *json.loads(c)] for v, c in changes]
+
+    def set_nickname(self, username, nickname):
+        with self.__transaction__() as db:
+            db.execute("UPDATE users SET nickname = ? WHERE username = ?", (nickname, username))
+
+    def get_contact_info(self, username, contact_name):
+        contacts = self.__contacts__(self.__query__(f"{self.CONTACTS} WHERE c.username = ? AND c.contact = ? ORDER BY g.rowid", username, contact_name))
+        if not contacts:
+            raise KeyError(contact_name)
+        return contacts[0]
+
+    def get_contacts_from_list(self, username, list_pos):
+        return self.__contacts__(self.__query__(f"{self.CONTACTS} JOIN lists l ON l.username = c.username AND l.contact = c.contact"
+            " WHERE l.username = ? AND l.list = ? ORDER BY l.rowid, g.rowid", username, list_pos))
+
+    def new_group(self, username, groupname):
+        with self.__transaction__() as db:
+            if db.execute("SELECT 1 FROM groups WHERE username = ? AND name = ?", (username, groupname)).fetchone() is not None:
+                return None
+            groupnum = db.execute("SELECT COALESCE(MAX(groupnum) + 1, 0) FROM groups WHERE username = ?", (username,)).fetchone()[0]
+            db.execute("INSERT INTO groups (username, groupnum, name) VALUES (?, ?, ?)", (username, groupnum, groupname))
+            self.__log_change__(db, username, ["ADG", groupname, groupnum])
+            return groupnum
+
+    def add_contact_to_list(self, username, contact_name, list_num):
+        with self.__transaction__() as db:
+            if db.execute("SELECT 1 FROM users WHERE username = ?", (contact_name,)).fetchone() is None:
+                #FIXME: refactor to remove hardcoded signal.com
+                if contact_name.split('@')[1] != 'signal.com':
+                    return NONEXISTENT_EMAIL
+                salt, key = self.__make_key__("")
+                db.execute("INSERT INTO users (username, nickname, salt, key) VALUES (?, ?, ?, ?)", (contact_name, contact_name, salt, key))
+                db.execute("INSERT INTO groups (username, groupnum, name) VALUES (?, 0, ?)", (contact_name, UserDatabase.DEFAULT_GROUP))
+                db.execute("INSERT OR REPLACE INTO list_versions (username, version) VALUES (?, 0)", (contact_name,))
+            if self.__in_list__(db, username, contact_name, list_num):
+                return USER_ALREADY_IN_LIST
+            if list_num == ListNumbers.ALLOW_LIST and self.__in_list__(db, username, contact_name, ListNumbers.BLOCK_LIST):
+                return USER_IN_ALLOW_AND_BLOCK
+            if list_num == ListNumbers.BLOCK_LIST and self.__in_list__(db, username, contact_name, ListNumbers.ALLOW_LIST):
+                return USER_IN_ALLOW_AND_BLOCK
+            db.execute("INSERT OR IGNORE INTO contacts (username, contact) VALUES (?, ?)", (username, contact_name))
+            db.execute("INSERT INTO lists (username, list, contact) VALUES (?, ?, ?)", (username, list_num, contact_name))
+            self.__log_change__(db, username, ["ADD", list_num, contact_name])
+            if list_num == ListNumbers.FORWARD_LIST:
+                db.execute("INSERT OR IGNORE INTO contacts (username, contact) VALUES (?, ?)", (contact_name, username))
+                if db.execute("INSERT OR IGNORE INTO lists (username, list, contact) VALUES (?, ?, ?)", (contact_name, ListNumbers.REVERSE_LIST, username)).rowcount > 0:
+                    self.__log_change__(db, contact_name, ["ADD", ListNumbers.REVERSE_LIST, username])
+        return SUCCESS
+
+    def remove_contact_from_list(self, username, contact_name, list_num):
+        with self.__transaction__() as db:
+            if db.execute("SELECT 1 FROM users WHERE username = ?", (contact_name,)).fetchone() is None:
+                return NONEXISTENT_EMAIL
+            if db.execute("DELETE FROM lists WHERE username = ? AND list = ? AND contact = ?", (username, list_num, contact_name)).rowcount == 0:
+                return USER_NOT_IN_LIST
+            self.__log_change__(db, username, ["REM", list_num, contact_name])
+            if list_num == ListNumbers.FORWARD_LIST:
+                if db.execute("DELETE FROM lists WHERE username = ? AND list = ? AND contact = ?", (contact_name, ListNumbers.REVERSE_LIST, username)).rowcount > 0:
+                    self.__log_change__(db, contact_name, ["REM", ListNumbers.REVERSE_LIST, username])
+        return SUCCESS
+
+    def add_to_group(self, username, groupnum, contact):
+        with self.__transaction__() as db:
+            if self.__has_group__(db, username, groupnum):
+                if db.execute("SELECT 1 FROM contacts WHERE username = ? AND contact = ?", (username, contact)).fetchone() is not None:
+                    if db.execute("INSERT OR IGNORE INTO contact_groups (username, contact, groupnum) VALUES (?, ?, ?)", (username, contact, groupnum)).rowcount > 0:
+                        self.__log_change__(db, username, ["ADD", ListNumbers.FORWARD_LIST, contact, groupnum])
+                    return True
+        return False
+
+    def del_group(self, username, groupnum):
+        if groupnum == 0:
+            return False
+        with self.__transaction__() as db:
+            if self.__has_group__(db, username, groupnum):
+                # the other groups keep their numbers, as in MD5JSON; its contacts are left in the default group
+                db.execute("DELETE FROM groups WHERE username = ? AND groupnum = ?", (username, groupnum))
+                db.execute("DELETE FROM contact_groups WHERE username = ? AND groupnum = ?", (username, groupnum))
+                self.__log_change__(db, username, ["RMG", groupnum])
+                return True
+        return False
+
+    def remove_from_group(self, username, groupnum, contact):
+        with self.__transaction__() as db:
+            if self.__has_group__(db, username, groupnum):
+                if db.execute("DELETE FROM contact_groups WHERE username = ? AND contact = ? AND groupnum = ?", (username, contact, groupnum)).rowcount > 0:
+                    self.__log_change__(db, username, ["REM", ListNumbers.FORWARD_LIST, contact, groupnum])
+                    return True
+        return False
+
+    def get_usernames_by_phone_number(self, number):
+        return [u for (u,) in self.__query__("SELECT username FROM users WHERE phone = ?", number)]
+
+class SQLiteTransaction():
+    # writers use BEGIN IMMEDIATE to take the write lock up front so check-then-insert sequences cannot race
+    def __init__(self, db, begin):
+        self.db = db
+        self.begin = begin
+        self.wait = metrics.LOCK_WAIT.labels("sqlite", "write" if begin == "BEGIN IMMEDIATE" else "read")
+    def __enter__(self):
+        start = time.perf_counter()
+        self.db.execute(self.begin)
+        self.wait.observe(time.perf_counter() - start)
+        return self.db
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
+
+def open_user_database(database_file):
+    # chooses the implementation from the file extension of {database_file}
+    if database_file.endswith((".db", ".sqlite", ".sqlite3")):
+        return MD5SQLite(database_file)
+    if database_file.endswith(".snap"):
+        return MD5Snapshot(database_file)
+    return MD5JSON(database_file)
@@ -0,0 +1,99 @@
+import sys
+import os
+import hashlib
+import json
+import tempfile
+import time
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Configuration
+# every login comes from 127.0.0.1 as fast as the bench can go, which the USR rate limits would shed;
+# set before auth.login builds the login queue
+Configuration.usr_rate = None
+Configuration.usr_rate_per_address = None
+from auth.user_database import MD5JSON, UserDatabase
+from auth.login import MD5LoginFactory
+from msn_handler import MSNHandler
+from msn_patcher import ErrorPatcher, KeepAlivePatcher
+from notification_server.presence import Presence
+from tcp import Connection
+
+# cost of notification server connection churn: open, log in (VER/INF/USR/USR/SYN/CHG), close
+# measured in-process with a socket that accepts everything, so only the server's own work is counted
+
+class NullSocket():
+    def send(self, data, flags=0):
+        return len(data)
+    def getsockname(self):
+        return ("127.0.0.1", Configuration.MSN_PORT)
+
+def entry(username):
+    return {
+        "nickname": username,
+        "salt": "salt",
+        "key": hashlib.md5("passwordsalt".encode("utf-8")).hexdigest(),
+        "groups": [UserDatabase.DEFAULT_GROUP],
+        "lists": {"FL": [], "AL": [], "BL": [], "RL": []},
+        "contacts": {}
+    }
+
+def make_database(directory, users):
+    path = os.path.join(directory, "users.json")
+    with open(path, 'w') as f:
+        json.dump({f"user{i}@example.com": entry(f"user{i}@example.com") for i in range(users)}, f)
+    return MD5JSON(path)
+
+def login(connection, username):
+    response = hashlib.md5("passwordsalt".encode("utf-8")).hexdigest()
+    connection.received(f"VER 1 MSNP6 MSNP2 CVR0\r\nINF 2\r\nUSR 3 MD5 I {username}\r\n".encode("utf-8"))
+    connection.received(f"USR 4 MD5 S {response}\r\nSYN 5 0\r\nCHG 6 NLN\r\n".encode("utf-8"))
+
+def main(users=1000, repeat=20000):
+    with tempfile.TemporaryDirectory() as directory:
+        database = make_database(directory, users)
+        presence = Presence(database)
+        patchers = [MD5LoginFactory(database, presence), KeepAlivePatcher, ErrorPatcher]
+        sock = NullSocket()
+        # warm up caches and lazily started threads
+        for i in range(100):
+            Connection(MSNHandler, patchers, sock, ("127.0.0.1", i), Configuration.idle_timeout).closed()
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        kept = [Connection(MSNHandler, patchers, sock, ("127.0.0.1", i), Configuration.idle_timeout) for i in range(1000)]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, "filename")
+        blocks = sum(s.count_diff for s in stats) / len(kept)
+        size = sum(s.size_diff for s in stats) / len(kept)
+        for connection in kept:
+            connection.closed()
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            Connection(MSNHandler, patchers, sock, ("127.0.0.1", i), Configuration.idle_timeout).closed()
+        opened = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            connection = Connection(MSNHandler, patchers, sock, ("127.0.0.1", i), Configuration.idle_timeout)
+            login(connection, f"user{i % users}@example.com")
+            connection.closed()
+        churn = (time.perf_counter() - start) / repeat
+
+        connection = Connection(MSNHandler, patchers, sock, ("127.0.0.1", 0), Configuration.idle_timeout)
+        login(connection, "user0@example.com")
+        start = time.perf_counter()
+        for _ in range(repeat):
+            connection.received(b"PNG\r\n")
+        ping = (time.perf_counter() - start) / repeat
+        connection.closed()
+
+        print(f"connection setup    {blocks:>8.1f} blocks {size:>8.0f} bytes per connection")
+        print(f"open + close        {opened * 1e6:>8.1f} us")
+        print(f"open + login + close{churn * 1e6:>8.1f} us")
+        print(f"PNG dispatch        {ping * 1e6:>8.1f} us")
+        database.close()
+
+if __name__ == "__main__":
+    main()
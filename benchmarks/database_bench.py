@@ -0,0 +1,115 @@
+import sys
+import os
+import json
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auth.user_database import MD5JSON, MD5Snapshot, MD5SQLite, UserDatabase
+from auth.snapshot import write_snapshot
+from auth.cached_database import CachedUserDatabase
+from auth.errors import SUCCESS
+from list_numbers import ListNumbers
+
+# login/SYN-style readers racing ADD/REM writers on one database; reader latency should not move when writers start
+
+def entry(username, forward, reverse):
+    return {
+        "nickname": username.split("@")[0],
+        "salt": "salt",
+        "key": "key",
+        "groups": [UserDatabase.DEFAULT_GROUP],
+        "lists": {"FL": forward, "AL": forward, "BL": [], "RL": reverse},
+        "contacts": {c: {"groups": [0], "phone": None} for c in dict.fromkeys(forward + reverse)}
+    }
+
+def make_database(directory, kind, users, roster):
+    if kind.endswith("+cache"):
+        db, names = make_database(directory, kind[:-len("+cache")], users, roster)
+        return CachedUserDatabase(db, size=users * 4), names
+    names = [f"user{i}@example.com" for i in range(users)]
+    database = {}
+    for i, name in enumerate(names):
+        forward = [names[(i + k) % users] for k in range(1, roster + 1)]
+        reverse = [names[(i - k) % users] for k in range(1, roster + 1)]
+        database[name] = entry(name, forward, reverse)
+    if kind == "sqlite":
+        db = MD5SQLite(os.path.join(directory, "users.db"))
+        for name, e in database.items():
+            db.import_user(name, e)
+        return db, names
+    if kind == "snapshot":
+        path = os.path.join(directory, "users.snap")
+        write_snapshot(path, database)
+        # a cache smaller than the user count so readers also parse from the snapshot
+        return MD5Snapshot(path, cache_size=users // 4), names
+    path = os.path.join(directory, "users.json")
+    with open(path, 'w') as f:
+        json.dump(database, f)
+    return MD5JSON(path), names
+
+def reader(db, names, stop, latencies, offset):
+    i = offset
+    while not stop.is_set():
+        name = names[i % len(names)]
+        start = time.perf_counter()
+        db.check_response(name, "key")
+        db.get_list_version(name)
+        for t in ListNumbers():
+            db.get_contacts_from_list(name, t)
+        latencies.append(time.perf_counter() - start)
+        i += 7
+
+def writer(db, names, stop, counts, offset, writers, roster):
+    # each writer only changes the users whose index is {offset} mod {writers}, so no two writers race on a pair
+    mine = range(offset, len(names), writers)
+    k = 0
+    while not stop.is_set():
+        i = mine[k % len(mine)]
+        # someone outside the roster, so ADD succeeds and REM undoes it
+        contact = names[(i + roster + 1) % len(names)]
+        assert db.add_contact_to_list(names[i], contact, ListNumbers.FORWARD_LIST) == SUCCESS
+        assert db.remove_contact_from_list(names[i], contact, ListNumbers.FORWARD_LIST) == SUCCESS
+        counts.append(2)
+        k += 13
+
+def run(name, db, names, readers, writers, seconds, roster):
+    stop = threading.Event()
+    latencies = [[] for _ in range(readers)]
+    counts = [[] for _ in range(writers)]
+    threads = [threading.Thread(target=reader, args=(db, names, stop, latencies[n], n)) for n in range(readers)]
+    threads += [threading.Thread(target=writer, args=(db, names, stop, counts[n], n, writers, roster)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    samples = sorted(x for l in latencies for x in l)
+    writes = sum(sum(c) for c in counts)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    print(f"{name:<22} {len(samples) / seconds:>9.0f} reads/s p50 {p(0.5):>7.3f} ms p99 {p(0.99):>7.3f} ms max {samples[-1] * 1000:>8.3f} ms {writes / seconds:>8.0f} writes/s")
+
+def check(db, names):
+    # every forward list entry is mirrored on the contact's reverse list
+    for name in names:
+        for c in db.get_contacts_from_list(name, ListNumbers.FORWARD_LIST):
+            assert name in [r.username for r in db.get_contacts_from_list(c.username, ListNumbers.REVERSE_LIST)], (name, c.username)
+
+def main(users=2000, roster=50, readers=8, writers=4, seconds=3):
+    for kind in ["json", "snapshot", "sqlite", "snapshot+cache", "sqlite+cache"]:
+        with tempfile.TemporaryDirectory() as directory:
+            db, names = make_database(directory, kind, users, roster)
+            print(f"{kind}: {users} users with {roster} contacts, {readers} reader threads")
+            # one pass over every user first, so the cached kinds are measured warm
+            for name in names:
+                for t in ListNumbers():
+                    db.get_contacts_from_list(name, t)
+            run("readers only", db, names, readers, 0, seconds, roster)
+            run(f"with {writers} writers", db, names, readers, writers, seconds, roster)
+            check(db, names)
+            if not kind.startswith("sqlite"):
+                db.close()
+
+if __name__ == "__main__":
+    main()
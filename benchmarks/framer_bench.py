@@ -0,0 +1,44 @@
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from framing import CommandFramer
+
+MESSAGE_BODY = "MIME-Version: 1.0\r\nContent-Type: text/plain; charset=UTF-8\r\nX-MMS-IM-Format: FN=Arial; EF=I; CO=0; CS=0; PF=22\r\n\r\n" + "hello there " * 20
+
+def make_stream(n):
+    body = MESSAGE_BODY.encode("utf-8")
+    parts = []
+    for trid in range(n):
+        if trid % 4 == 0:
+            parts.append(f"MSG {trid} N {len(body)}\r\n".encode("utf-8") + body)
+        else:
+            parts.append(f"CHG {trid} NLN\r\n".encode("utf-8"))
+    return b"".join(parts)
+
+def chunk(stream, size):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+def run(name, chunks, expected, repeat):
+    total_bytes = sum(len(c) for c in chunks)
+    best = None
+    for _ in range(repeat):
+        framer = CommandFramer()
+        count = 0
+        start = time.perf_counter()
+        for c in chunks:
+            count += len(framer.feed(c))
+        elapsed = time.perf_counter() - start
+        assert count == expected, f"{name}: framed {count} commands, expected {expected}"
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<24} {expected / best:>12,.0f} cmds/s {total_bytes / best / 1e6:>8.1f} MB/s ({len(chunks)} segments)")
+
+def main(n=20000, repeat=5):
+    stream = make_stream(n)
+    run("pipelined (64 KiB)", chunk(stream, 65536), n, repeat)
+    run("recv-sized (1 KiB)", chunk(stream, 1024), n, repeat)
+    run("fragmented (61 B)", chunk(stream, 61), n, repeat)
+    run("byte-at-a-time", chunk(make_stream(n // 20), 1), n // 20, 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Configuration
+from switchboard.session import TEXT_HEADERS
+
+# simulates concurrent MSNP clients against a real server and reports latency per command as JSON
+#   python benchmarks/loadgen.py login-storm --clients 200
+#   python benchmarks/loadgen.py syn --clients 20 --roster 500
+#   python benchmarks/loadgen.py all --set server_mode=asyncio --output results.json
+# without --connect a server is started from main.py on a fresh database with the in-memory Signal transport
+# with --connect, build the database first with --setup and point the server's user_database_file at it
+
+PASSWORD = "loadgen"
+DOMAIN = "loadgen.test"
+SIGNAL_CONTACT = "15550000000@signal.com"
+SETUP = ("connect", "login", "sb connect")
+
+def username(i):
+    return f"load{i}@{DOMAIN}"
+
+def entry(name, salt, forward, reverse):
+    return {
+        "nickname": name.split("@")[0],
+        "salt": salt,
+        "key": hashlib.md5(f"{PASSWORD}{salt}".encode('utf-8')).hexdigest(),
+        "groups": ["Other%20Contacts"],
+        "lists": {"FL": forward, "AL": forward, "BL": [], "RL": reverse},
+        "contacts": {c: {"groups": [0], "phone": None} for c in dict.fromkeys(forward + reverse)},
+        "list_ver": 1,
+        "changes": []
+    }
+
+def setup_database(path, clients, roster):
+    # every user has the next {roster} users on their forward list and the previous ones on their reverse list
+    from auth.user_database import MD5SQLite
+    database = MD5SQLite(path)
+    roster = min(roster, clients - 1)
+    for i in range(clients):
+        forward = [username((i + k) % clients) for k in range(1, roster + 1)]
+        reverse = [username((i - k) % clients) for k in range(1, roster + 1)]
+        database.import_user(username(i), entry(username(i), f"salt{i}", forward, reverse))
+    database.import_user(SIGNAL_CONTACT, entry(SIGNAL_CONTACT, "signal", [], []))
+
+class Recorder():
+    def __init__(self):
+        self.samples = {} # name -> [seconds, ...]
+        self.errors = {} # name -> count
+        self.notifications = {} # command -> count
+        self.failures = []
+
+    def record(self, name, elapsed, error=False):
+        self.samples.setdefault(name, []).append(elapsed)
+        if error:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def notify(self, command):
+        self.notifications[command] = self.notifications.get(command, 0) + 1
+
+    def summary(self, name, elapsed):
+        samples = sorted(self.samples[name])
+        def percentile(p):
+            return round(samples[max(0, math.ceil(p / 100 * len(samples)) - 1)] * 1000, 3)
+        return {
+            "count": len(samples),
+            "errors": self.errors.get(name, 0),
+            "per_second": round(len(samples) / elapsed, 1) if elapsed > 0 else None,
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+            "p50_ms": percentile(50),
+            "p95_ms": percentile(95),
+            "p99_ms": percentile(99),
+            "max_ms": round(samples[-1] * 1000, 3)
+        }
+
+    def report(self, elapsed):
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "setup": {k: self.summary(k, elapsed) for k in SETUP if k in self.samples},
+            "commands": {k: self.summary(k, elapsed) for k in sorted(self.samples) if k not in SETUP},
+            "notifications": dict(sorted(self.notifications.items())),
+            "failed_clients": len(self.failures),
+            "failures": sorted(set(self.failures))
+        }
+
+class Client():
+    # one simulated connection; replies are matched to commands by transaction id
+    def __init__(self, recorder, timeout):
+        self.recorder = recorder
+        self.timeout = timeout
+        self.trids = itertools.count(1)
+        self.pending = {} # trid -> [done(parts), future, lines]
+        self.queues = {} # notification command -> asyncio.Queue, for the ones a scenario waits on
+        self.reader = None
+        self.writer = None
+        self.reading = None
+
+    async def connect(self, host, port, name="connect"):
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.recorder.record(name, time.perf_counter() - start)
+        self.reading = asyncio.create_task(self.read_loop())
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        if self.reading is not None:
+            await self.reading
+
+    def watch(self, command):
+        self.queues.setdefault(command, asyncio.Queue())
+
+    async def expect(self, command):
+        return await asyncio.wait_for(self.queues[command].get(), self.timeout)
+
+    async def command(self, name, line, done=None, payload=None):
+        # sends "{cmd} {trid} {line}" and waits until done(parts) accepts a reply line; returns the reply lines
+        trid = str(next(self.trids))
+        cmd, _, rest = line.partition(" ")
+        done = done or (lambda parts: parts[0] == cmd)
+        future = asyncio.get_running_loop().create_future()
+        lines = []
+        self.pending[trid] = [done, future, lines]
+        data = f"{cmd} {trid} {rest}\r\n".encode("utf-8")
+        if payload is not None:
+            data = f"{cmd} {trid} {rest} {len(payload)}\r\n".encode("utf-8") + payload
+        start = time.perf_counter()
+        self.writer.write(data)
+        try:
+            error = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.recorder.record(name, time.perf_counter() - start, error=True)
+            raise RuntimeError(f"{name} timed out")
+        finally:
+            self.pending.pop(trid, None)
+        self.recorder.record(name, time.perf_counter() - start, error=error)
+        return lines
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+                parts = line.decode("utf-8").rstrip("\r\n").split(" ")
+                if parts[0] == "MSG":
+                    payload = await self.reader.readexactly(int(parts[-1]))
+                    self.received_message(payload.decode("utf-8"))
+                elif len(parts) > 1 and parts[1] in self.pending:
+                    done, future, lines = self.pending[parts[1]]
+                    lines.append(parts)
+                    if future.done():
+                        continue
+                    if parts[0].isdigit():
+                        future.set_result(True)
+                    elif done(parts):
+                        future.set_result(False)
+                else:
+                    self.recorder.notify(parts[0])
+                    if parts[0] in self.queues:
+                        self.queues[parts[0]].put_nowait(parts)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return
+        finally:
+            for _, future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(RuntimeError("connection closed"))
+
+    def received_message(self, payload):
+        self.recorder.notify("MSG")
+        # the body carries the sender's clock; both ends run on the same host
+        body = payload.partition("\r\n\r\n")[2]
+        if body.startswith("t="):
+            self.recorder.record("MSG delivery", time.perf_counter() - float(body[2:]))
+
+def syn_done(version):
+    # a full dump ends with the last reverse list line; an up to date client only gets the SYN line
+    def done(parts):
+        if parts[0] == "SYN":
+            return int(parts[2]) == version
+        return parts[0] == "LST" and parts[2] == "RL" and parts[4] == parts[5]
+    return done
+
+async def login(options, recorder, i, status="NLN"):
+    start = time.perf_counter()
+    client = Client(recorder, options.timeout)
+    await client.connect(options.host, options.port)
+    await client.command("VER", "VER MSNP6 MSNP2 CVR0")
+    await client.command("INF", "INF")
+    salt = (await client.command("USR I", f"USR MD5 I {username(i)}"))[-1][-1]
+    key = hashlib.md5(f"{PASSWORD}{salt}".encode('utf-8')).hexdigest()
+    await client.command("USR S", f"USR MD5 S {key}")
+    await client.command("SYN", "SYN 0", done=syn_done(0))
+    await client.command("CHG", f"CHG {status}")
+    recorder.record("login", time.perf_counter() - start)
+    return client
+
+async def run_all(recorder, coroutines):
+    # runs every client at once; a failed client is counted and comes back as None rather than stopping the rest
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for ix, result in enumerate(results):
+        if isinstance(result, BaseException):
+            recorder.failures.append(f"{type(result).__name__}: {result}")
+            results[ix] = None
+    return results
+
+async def login_all(options, recorder):
+    return await run_all(recorder, [login(options, recorder, i) for i in range(options.clients)])
+
+async def close_all(clients):
+    await asyncio.gather(*[c.close() for c in clients if c is not None])
+
+async def login_storm(options, recorder):
+    async def scenario(i):
+        client = await login(options, recorder, i)
+        await client.close()
+    await run_all(recorder, [scenario(i) for i in range(options.clients)])
+
+async def syn(options, recorder):
+    async def scenario(client):
+        for _ in range(options.iterations):
+            await client.command("SYN full", "SYN 0", done=syn_done(0))
+            await client.command("SYN current", "SYN 1", done=syn_done(1))
+    clients = await login_all(options, recorder)
+    await run_all(recorder, [scenario(c) for c in clients if c is not None])
+    await close_all(clients)
+
+async def presence(options, recorder):
+    # everyone logs in first so each status change fans out to online watchers
+    async def scenario(client):
+        for n in range(options.iterations):
+            await client.command("CHG", f"CHG {('BSY', 'AWY', 'NLN')[n % 3]}")
+    clients = await login_all(options, recorder)
+    await run_all(recorder, [scenario(c) for c in clients if c is not None])
+    # let the fan-out drain before the watchers go away
+    await asyncio.sleep(options.drain)
+    await close_all(clients)
+
+async def roster(options, recorder):
+    async def scenario(i, client):
+        for n in range(options.iterations):
+            contact = username((i + options.roster + 1 + n) % options.clients)
+            await client.command("ADD", f"ADD FL {contact} {contact.split('@')[0]}")
+            await client.command("REM", f"REM FL {contact}")
+    clients = await login_all(options, recorder)
+    await run_all(recorder, [scenario(i, c) for i, c in enumerate(clients) if c is not None])
+    await close_all(clients)
+
+async def chat(options, recorder):
+    # clients pair up: the even one invites the odd one (and the Signal contact) and sends it messages
+    async def answer(i, ns):
+        rng = await ns.expect("RNG")
+        sb = Client(recorder, options.timeout)
+        await sb.connect(options.host, int(rng[2].split(":")[1]), name="sb connect")
+        await sb.command("ANS", f"ANS {username(i)} {rng[4]} {rng[1]}")
+        return sb
+    async def scenario(i, ns, callee_ns):
+        callee_ns.watch("RNG")
+        xfr = (await ns.command("XFR", "XFR SB"))[-1]
+        sb = Client(recorder, options.timeout)
+        sessions.append(sb)
+        await sb.connect(options.host, int(xfr[3].split(":")[1]), name="sb connect")
+        sb.watch("JOI")
+        await sb.command("USR SB", f"USR {username(i)} {xfr[5]}")
+        answering = asyncio.create_task(answer(i + 1, callee_ns))
+        await sb.command("CAL", f"CAL {username(i + 1)}")
+        sessions.append(await answering)
+        await sb.expect("JOI")
+        await sb.command("CAL signal", f"CAL {SIGNAL_CONTACT}")
+        for _ in range(options.iterations):
+            body = f"t={time.perf_counter()}".encode("utf-8")
+            await sb.command("MSG", "MSG A", done=lambda parts: parts[0] in ("ACK", "NAK"), payload=TEXT_HEADERS.encode("utf-8") + body)
+    sessions = []
+    clients = await login_all(options, recorder)
+    pairs = [(i, clients[i], clients[i + 1]) for i in range(0, len(clients) - 1, 2)]
+    await run_all(recorder, [scenario(*p) for p in pairs if None not in p])
+    await asyncio.sleep(options.drain)
+    for sb in sessions:
+        if sb.writer is not None:
+            sb.writer.write(b"OUT\r\n")
+    await close_all(sessions)
+    await close_all(clients)
+
+SCENARIOS = {
+    "login-storm": login_storm,
+    "syn": syn,
+    "presence": presence,
+    "roster": roster,
+    "chat": chat
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def serve(config, clients, roster):
+    # own process group so the server's child processes can be stopped together
+    os.setpgrp()
+    # applied before any server module is imported, since they read their defaults at import time
+    for key, value in config.items():
+        setattr(Configuration, key, value)
+    setup_database(Configuration.user_database_file, clients, roster)
+    import main
+    main.main()
+
+def wait_for_server(server, host, ports, timeout):
+    deadline = time.monotonic() + timeout
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection((host, port), 1).close()
+                break
+            except OSError:
+                if not server.is_alive() or time.monotonic() > deadline:
+                    raise RuntimeError(f"server did not start listening on {host}:{port}")
+                time.sleep(0.05)
+
+def wait_for_exit(pgid, timeout):
+    # the server's processes flush and close on SIGTERM; the next scenario must not find their ports still bound
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return
+        time.sleep(0.05)
+    os.killpg(pgid, signal.SIGKILL)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scenario(name, options, overrides):
+    recorder = Recorder()
+    server = None
+    with tempfile.TemporaryDirectory() as directory:
+        if options.connect is None:
+            config = {
+                "debug": False,
+                "IP_ADDR": "127.0.0.1",
+                "MSN_PORT": free_port(),
+                "SB_PORT": free_port(),
+                "metrics_port": free_port(),
+                "listeners": 128,
+                # every simulated client connects from 127.0.0.1, so only the process-wide limits apply
+                "max_connections_per_address": None,
+                "connect_rate_per_address": None,
+                "usr_rate_per_address": None,
+                "signal_transport": "memory",
+                "user_database_file": os.path.join(directory, "users.db"),
+                "directory_socket": os.path.join(directory, "directory.sock"),
+                **overrides
+            }
+            options.host, options.port = "127.0.0.1", config["MSN_PORT"]
+            server = Process(target=serve, args=(config, options.clients, options.roster))
+            server.start()
+            # building the database for a large run takes a while
+            wait_for_server(server, options.host, (config["MSN_PORT"], config["SB_PORT"]), 60 + options.timeout)
+        else:
+            config = overrides
+            options.host, _, port = options.connect.partition(":")
+            options.port = int(port or Configuration.MSN_PORT)
+        try:
+            start = time.perf_counter()
+            asyncio.run(SCENARIOS[name](options, recorder))
+            elapsed = time.perf_counter() - start
+        finally:
+            if server is not None:
+                os.killpg(server.pid, signal.SIGTERM)
+                server.join()
+                wait_for_exit(server.pid, 10)
+    return {
+        "scenario": name,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "options": {k: getattr(options, k) for k in ("clients", "roster", "iterations")},
+        "config": {k: v for k, v in config.items() if k not in ("user_database_file", "directory_socket")},
+        **recorder.report(elapsed)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent MSNP clients and report per-command latency")
+    parser.add_argument("scenario", choices=[*SCENARIOS, "all"])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--roster", type=int, default=20, help="forward list size of every user")
+    parser.add_argument("--iterations", type=int, default=10, help="repetitions of the scenario's command per client")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for a reply")
+    parser.add_argument("--drain", type=float, default=0.5, help="seconds to wait for notifications before disconnecting")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Configuration override for the spawned server")
+    parser.add_argument("--connect", metavar="HOST[:PORT]", help="use a running server instead of spawning one")
+    parser.add_argument("--setup", metavar="DATABASE", help="only write the load test users to an SQLite database")
+    parser.add_argument("--output", help="also write the results to this file")
+    options = parser.parse_args()
+    if options.setup:
+        setup_database(options.setup, options.clients, options.roster)
+        return
+    overrides = {}
+    for setting in options.set:
+        key, _, value = setting.partition("=")
+        if not hasattr(Configuration, key):
+            parser.error(f"unknown setting {key}")
+        overrides[key] = parse_value(value)
+    names = list(SCENARIOS) if options.scenario == "all" else [options.scenario]
+    results = [run_scenario(name, options, overrides) for name in names]
+    for result in results:
+        for name, stats in {**result["setup"], **result["commands"]}.items():
+            sys.stderr.write(f"{result['scenario']:<12} {name:<12} {stats['count']:>7} {stats['per_second'] or 0:>9.1f}/s p50 {stats['p50_ms']:>8.2f} ms p95 {stats['p95_ms']:>8.2f} ms p99 {stats['p99_ms']:>8.2f} ms errors {stats['errors']}\n")
+    output = json.dumps(results[0] if len(results) == 1 else results, indent=2)
+    print(output)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+from msn_handler import MSNHandler
+from msn_patcher import MSNPatcher
+
+class NullPatcher(MSNPatcher):
+    # a CHG that does nothing, so only dispatch and the timing around it are measured
+    __slots__ = ()
+    commands = {
+        "CHG": "change_status"
+    }
+
+    def change_status(self, data):
+        pass
+
+def run(name, func, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed / n * 1e9:>8.0f} ns/op")
+    return elapsed / n
+
+def main(n=200000):
+    counter = metrics.counter("bench_total", "benchmark counter")
+    histogram = metrics.histogram("bench_seconds", "benchmark histogram", ["command"])
+    child = histogram.labels("CHG")
+    handler = MSNHandler()
+    NullPatcher(None).patch(handler)
+    run("counter.inc", counter.inc, n)
+    run("histogram.labels().observe", lambda: histogram.labels("CHG").observe(0.0001), n)
+    run("cached child observe", lambda: child.observe(0.0001), n)
+    run("MSNHandler.handle (timed)", lambda: handler.handle("CHG 1 NLN\r\n"), n)
+    start = time.perf_counter()
+    text = metrics.REGISTRY.expose()
+    print(f"exposition: {len(text)} bytes in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    main()
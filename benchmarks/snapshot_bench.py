@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auth.snapshot import name_hash, encode_record, write_records
+from list_numbers import ListNumbers
+
+# startup time and resident memory of MD5JSON against MD5Snapshot as the user count grows
+#   python benchmarks/snapshot_bench.py --users 10000 100000 1000000 --formats snapshot
+# each database is opened in a fresh interpreter, which then logs in a sample of users
+
+def username(i):
+    return f"user{i}@example.com"
+
+def entry(i, users, roster):
+    forward = [username((i + k) % users) for k in range(1, roster + 1)]
+    reverse = [username((i - k) % users) for k in range(1, roster + 1)]
+    return {
+        "list_ver": 1,
+        "nickname": f"user{i}",
+        "salt": "salt",
+        "key": "key",
+        "groups": ["Other%20Contacts"],
+        "lists": {"FL": forward, "AL": forward, "BL": [], "RL": reverse},
+        "contacts": {c: {"groups": [0], "phone": None} for c in dict.fromkeys(forward + reverse)}
+    }
+
+def write_json(path, users, roster):
+    # streamed, so the generator does not need the whole database in memory
+    with open(path, 'w') as f:
+        f.write("{")
+        for i in range(users):
+            f.write(f"{',' if i else ''}{json.dumps(username(i))}:{json.dumps(entry(i, users, roster), separators=(',', ':'))}")
+        f.write("}")
+
+def write_snap(path, users, roster):
+    hashes = [name_hash(username(i)) for i in range(users)]
+    order = sorted(range(users), key=hashes.__getitem__)
+    with open(path, 'wb') as f:
+        write_records(f, ((hashes[i], encode_record(username(i), entry(i, users, roster))) for i in order))
+
+def memory():
+    # (resident, anonymous) in MiB; the difference is mapped file pages, which the kernel can drop
+    fields = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            fields[name] = value.strip()
+    return int(fields["VmRSS"].split()[0]) / 1024, int(fields["RssAnon"].split()[0]) / 1024
+
+def child(kind, path, users, logins):
+    from auth.user_database import MD5JSON, MD5Snapshot
+    baseline = memory()[1]
+    start = time.perf_counter()
+    db = MD5Snapshot(path) if kind == "snapshot" else MD5JSON(path)
+    opened = time.perf_counter() - start
+    after_open = memory()[1]
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(logins):
+        name = username(rng.randrange(users))
+        db.check_response(name, "key")
+        db.get_list_version(name)
+        for t in ListNumbers():
+            db.get_contacts_from_list(name, t)
+    logged_in = time.perf_counter() - start
+    resident, anonymous = memory()
+    print(json.dumps({"open": opened, "login": logged_in / logins, "open_anon": after_open - baseline,
+        "anon": anonymous - baseline, "rss": resident}))
+
+def measure(kind, path, users, logins):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", kind, path, str(users), str(logins)],
+        capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and memory of the JSON and snapshot user databases")
+    parser.add_argument("--users", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--roster", type=int, default=5, help="contacts per user")
+    parser.add_argument("--logins", type=int, default=1000, help="random users looked up after opening")
+    parser.add_argument("--formats", nargs="+", default=["json", "snapshot"], choices=["json", "snapshot"])
+    parser.add_argument("--child", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        kind, path, users, logins = args.child
+        child(kind, path, int(users), int(logins))
+        return
+    # memory is what the database added to the process, not counting the mapped file; RSS is the whole process
+    print(f"{'users':>9} {'format':<9} {'file MiB':>9} {'open s':>8} {'login ms':>9} {'mem after open':>15} {'mem after logins':>17} {'RSS':>10}")
+    for users in args.users:
+        with tempfile.TemporaryDirectory() as directory:
+            for kind in args.formats:
+                path = os.path.join(directory, "users.snap" if kind == "snapshot" else "users.json")
+                (write_snap if kind == "snapshot" else write_json)(path, users, args.roster)
+                size = os.path.getsize(path) / 2**20
+                result = measure(kind, path, users, args.logins)
+                if result is None:
+                    print(f"{users:>9} {kind:<9} {size:>9.1f} failed (out of memory?)")
+                    continue
+                print(f"{users:>9} {kind:<9} {size:>9.1f} {result['open']:>8.3f} {result['login'] * 1000:>9.3f} "
+                      f"{result['open_anon']:>11.1f} MiB {result['anon']:>13.1f} MiB {result['rss']:>6.1f} MiB", flush=True)
+                os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Configuration
+from msn_handler import MSNHandler
+from switchboard.patcher import SwitchBoardFactory
+from switchboard.session import TEXT_HEADERS
+from switchboard.transport import MemoryTransport
+from tcp import Connection
+
+class CountingSocket():
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+    def send(self, data, flags=0):
+        # takes everything, so Connection never queues
+        self.calls += 1
+        self.bytes += len(data)
+        return len(data)
+    def getsockname(self):
+        return ("127.0.0.1", Configuration.SB_PORT)
+
+class StubDatabase():
+    def check_username(self, username):
+        return True
+    def get_nickname(self, username):
+        return username.split('@')[0]
+    def get_connection_for_user(self, username):
+        return None
+
+def make_session(participants):
+    factory = SwitchBoardFactory(StubDatabase(), MemoryTransport())
+    connections = []
+    for i in range(participants):
+        sock = CountingSocket()
+        connection = Connection(MSNHandler, [factory], sock, ("127.0.0.1", i))
+        if i == 0:
+            ticket = factory.tickets.issue(f"user{i}@example.com", f"user{i}")
+            connection.received(f"USR 1 user{i}@example.com {ticket}\r\n".encode("utf-8"))
+            sb_id = connection.patchers[0].session.sb_id
+        else:
+            ticket = factory.tickets.issue(f"user{i}@example.com", f"user{i}", sb_id)
+            connection.received(f"ANS 1 user{i}@example.com {ticket} {sb_id}\r\n".encode("utf-8"))
+        connections.append((connection, sock))
+    return connections
+
+def run(participants, messages):
+    connections = make_session(participants)
+    payload = f"{TEXT_HEADERS}hello from the benchmark".encode("utf-8")
+    segment = f"MSG 2 A {len(payload)}\r\n".encode("utf-8") + payload
+    sender = connections[0][0]
+    for _, sock in connections:
+        sock.calls = sock.bytes = 0
+    start = time.perf_counter()
+    for _ in range(messages):
+        sender.received(segment)
+    elapsed = time.perf_counter() - start
+    delivered = sum(sock.calls for _, sock in connections[1:])
+    print(f"{participants:>3} participants {messages / elapsed:>10,.0f} msgs/s {delivered / elapsed:>12,.0f} deliveries/s")
+
+def main(messages=20000):
+    Configuration.debug = False
+    for participants in [2, 10, 50]:
+        run(participants, messages)
+
+if __name__ == "__main__":
+    main()
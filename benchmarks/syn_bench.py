@@ -0,0 +1,68 @@
+import sys
+import os
+import json
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Configuration
+from auth.user_database import MD5JSON, UserDatabase
+from msn_handler import MSNHandler
+from notification_server.synchroniser import SynchroniserMSNP6
+from notification_server.presence import Presence
+from tcp import Connection
+
+class CountingSocket():
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+    def send(self, data, flags=0):
+        # takes everything, so Connection never queues
+        self.calls += 1
+        self.bytes += len(data)
+        return len(data)
+    def getsockname(self):
+        return ("127.0.0.1", Configuration.MSN_PORT)
+
+def entry(username, forward=(), reverse=()):
+    return {
+        "nickname": username,
+        "salt": "salt",
+        "key": "key",
+        "groups": [UserDatabase.DEFAULT_GROUP],
+        "lists": {"FL": list(forward), "AL": list(forward), "BL": [], "RL": list(reverse)},
+        "contacts": {c: {"groups": [0], "phone": None} for c in forward or reverse}
+    }
+
+def make_database(directory, contacts):
+    names = [f"contact{i}@example.com" for i in range(contacts)]
+    database = {name: entry(name, reverse=["user@example.com"]) for name in names}
+    database["user@example.com"] = entry("user@example.com", forward=names)
+    path = os.path.join(directory, "users.json")
+    with open(path, 'w') as f:
+        json.dump(database, f)
+    return MD5JSON(path)
+
+def run(name, database, corked, repeat):
+    sock = CountingSocket()
+    presence = Presence(database)
+    connection = Connection(MSNHandler, [lambda c: SynchroniserMSNP6(database, presence, c)], sock, ("127.0.0.1", 0))
+    connection.username = "user@example.com"
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if corked:
+            connection.received(b"SYN 1 0\r\n")
+        else:
+            connection.handler.handle("SYN 1 0\r\n")
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:<10} {sock.calls / repeat:>8.0f} writes/SYN {sock.bytes / repeat:>10.0f} bytes/SYN {elapsed * 1000:>8.2f} ms/SYN")
+
+def main(contacts=500, repeat=20):
+    Configuration.debug = False
+    with tempfile.TemporaryDirectory() as directory:
+        database = make_database(directory, contacts)
+        print(f"SYN for a {contacts}-contact roster")
+        run("uncorked", database, False, repeat)
+        run("corked", database, True, repeat)
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,63 @@ from dataclasses import dataclass
 
 @dataclass
 class Configuration():
-    permitted_versions = "MSNP6 MSNP2"
-    debug = True
-    user_database_file = None
+    permitted_versions = "MSNP7 MSNP6 MSNP2" # newest first; VER picks the first one the client offers
+    debug = False # trace every connection to stdout
+    user_database_file = None # .db/.sqlite/.sqlite3 selects MD5SQLite, .snap MD5Snapshot, anything else MD5JSON
+    snapshot_cache_size = 10000 # users MD5Snapshot keeps parsed in memory, besides those changed since the last compaction
+    user_cache_size = 50000 # nicknames, contact infos and contact lists kept by the cache in front of the user database; 0 to disable
+    user_cache_ttl = 30 # seconds a cached lookup is trusted, which bounds staleness from writes made by other processes
+    journal_compact_after = 1000 # journal records before the snapshot is rewritten
+    journal_compact_interval = 60 # seconds
+    journal_flush_interval = 0.05 # seconds between coalesced journal writes
+    journal_flush_batch = 256 # dirty users that trigger an early journal write
+    journal_fsync = "batch" # "batch", "interval" or "shutdown" (when the notification server process exits)
+    journal_fsync_interval = 0.1 # seconds between fsyncs when journal_fsync is "interval"
+    list_change_log_size = 100 # list changes kept per user for incremental SYN
     MSN_PORT = 1863
     SB_PORT = 1864
     IP_ADDR = "0.0.0.0"
-    listeners = 5
-    sb_auth_string = "17262740.1050826919.32308"
\ No newline at end of file
+    max_command_length = 8192 # bytes in one command line before the connection is dropped
+    max_payload_length = 65536 # bytes in one MSG/UUX/QRY payload before the connection is dropped
+    listeners = 128 # listen() backlog of each server socket; the kernel caps it at net.core.somaxconn
+    max_connections = 10000 # connections open at once per server process before new ones are closed at accept; None for no cap
+    max_connections_per_address = 1000 # the same for one client IP address, which may be a whole office behind NAT
+    connect_rate = 200 # new connections per second per server process, in bursts of up to connect_burst; None to disable
+    connect_burst = 1000
+    connect_rate_per_address = 50 # the same for one client IP address
+    connect_burst_per_address = 200
+    usr_rate = 400 # USR commands per second per notification server process (a login takes two); None to disable
+    usr_burst = 2000
+    usr_rate_per_address = 100 # the same for one client IP address
+    usr_burst_per_address = 400
+    admission_addresses = 100000 # client addresses whose rate limits are remembered, least recently seen forgotten first
+    login_concurrency = 8 # logins handled at once per process; later ones wait their turn in order
+    login_queue_size = 1000 # logins waiting before further ones are answered with 600 (server busy)
+    login_queue_timeout = 5 # seconds a login waits for its turn before it is answered with 600
+    outbound_high_watermark = 256 * 1024 # bytes queued for a client before it counts as a slow consumer
+    outbound_low_watermark = 64 * 1024 # bytes queued for a slow consumer once it has caught up again
+    outbound_limit = 1024 * 1024 # bytes queued for a client before it is disconnected whatever the policy
+    slow_consumer_policy = "coalesce" # presence updates for a slow consumer: "coalesce" (latest per contact), "drop" or "disconnect"
+    timer_tick = 0.1 # seconds per slot of the timer wheel
+    idle_timeout = 180 # seconds without a command before a notification server connection is dropped (clients PNG about every 50); None to disable
+    sb_idle_timeout = 300 # the same for switchboard connections
+    server_mode = "threaded" # "threaded" or "asyncio"
+    workers = 1 # notification server processes sharing MSN_PORT via SO_REUSEPORT; more than one needs an SQLite user_database_file
+    worker_restart_delay = 1 # seconds before a crashed worker is replaced
+    signal_transport = "dbus" # "dbus" or "memory"
+    signal_queue_size = 1000 # messages waiting for signal-cli before new ones are refused
+    signal_batch_size = 32 # messages handed to the transport per wakeup
+    signal_retries = 3
+    signal_retry_delay = 0.5 # seconds, multiplied by the attempt number
+    directory_socket = "/tmp/msn-signal-directory.sock" # Unix socket shared by the server processes; None to disable (XFR still works, but CAL then only reaches Signal contacts)
+    trace_buffer_size = 10000 # protocol trace records kept in memory per process
+    trace_file = None # file the trace writer appends to, "-" for stdout, or None to keep records in memory until dumped
+    trace_flush_interval = 0.2 # seconds between trace writes
+    trace_sample = 0.0 # fraction of connections traced
+    trace_users = () # usernames always traced
+    trace_filter_file = None # re-read while running to change trace_users, trace_sample and traced client addresses
+    trace_dump_file = "/tmp/msn-trace-{pid}.log" # where SIGUSR1 dumps a process's trace ring
+    metrics_ip = "127.0.0.1"
+    metrics_port = 9186 # Prometheus endpoint; notification server worker n uses metrics_port + n, the switchboard the next port after them; None to disable
+    sb_ticket_lifetime = 60 # seconds an XFR or RNG ticket can be redeemed at the switchboard
+    sb_ticket_secret = None # key XFR tickets are signed with, shared by the notification server and switchboard; None for a random one per main.py run
\ No newline at end of file
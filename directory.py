@@ -0,0 +1,257 @@
+import json
+import os
+import socket
+import sys
+import threading
+from multiprocessing import Event, Process
+from config import Configuration
+from process_local import ProcessLocal
+
+# line-delimited JSON over a Unix socket shared by every server process
+# ops from clients: register, unregister, status, deliver, watchers (someone's forward list gained or lost {user})
+# ops to clients: presence (status changes, and every online user when a client connects), deliver, watchers
+# every process keeps a replica of the status table, so looking a user up never waits on another process
+
+def encode(message):
+    return f"{json.dumps(message, separators=(',', ':'))}\n".encode("utf-8")
+
+class DirectoryServer(Process):
+    # owns the username -> (process, status) table for every connected user
+    def __init__(self, path=Configuration.directory_socket):
+        super().__init__(daemon=True)
+        self.path = path
+        self.owners = {} # username -> (peer, status)
+        self.peers = set()
+        self.lock = threading.Lock()
+        self.listening = Event() # set once the socket accepts connections
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _sock.bind(self.path)
+        _sock.listen()
+        self.listening.set()
+        try:
+            while True:
+                connection, _ = _sock.accept()
+                threading.Thread(target=self.serve, args=[DirectoryPeer(connection)], daemon=True).start()
+        finally:
+            _sock.close()
+
+    def wait_ready(self, timeout=10):
+        # the server processes connect as they start, so they must not be started before the socket is up
+        if not self.listening.wait(timeout):
+            raise SystemExit(f"Session directory did not start listening at {self.path}")
+
+    def serve(self, peer):
+        with self.lock:
+            self.peers.add(peer)
+            peer.send({"op": "presence", "statuses": {u: s for u, (_, s) in self.owners.items()}})
+        try:
+            for line in peer.connection.makefile('rb'):
+                message = json.loads(line)
+                getattr(self, f"op_{message['op']}")(peer, message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            # a process that goes away takes its users with it
+            with self.lock:
+                self.peers.discard(peer)
+                gone = {}
+                for username in peer.owned:
+                    if self.owners.get(username, (None,))[0] is peer:
+                        del self.owners[username]
+                        gone[username] = "FLN"
+                self.publish(gone)
+            peer.connection.close()
+
+    def publish(self, statuses):
+        # called with the lock held, so every replica sees the changes in the order they were made
+        if statuses:
+            for peer in self.peers:
+                peer.send({"op": "presence", "statuses": statuses})
+
+    def op_register(self, peer, message):
+        with self.lock:
+            self.owners[message['user']] = (peer, message['status'])
+            peer.owned.add(message['user'])
+            self.publish({message['user']: message['status']})
+
+    def op_unregister(self, peer, message):
+        with self.lock:
+            if self.owners.get(message['user'], (None,))[0] is peer:
+                del self.owners[message['user']]
+                self.publish({message['user']: "FLN"})
+            peer.owned.discard(message['user'])
+
+    def op_status(self, peer, message):
+        with self.lock:
+            if self.owners.get(message['user'], (None,))[0] is peer:
+                self.owners[message['user']] = (peer, message['status'])
+                self.publish({message['user']: message['status']})
+
+    def op_watchers(self, peer, message):
+        # every other process drops what it knows about who watches {user}
+        with self.lock:
+            peers = [p for p in self.peers if p is not peer]
+        for p in peers:
+            p.send(message)
+
+    def op_deliver(self, peer, message):
+        # regroup per owning process so each process gets one message; users not (yet) online are dropped
+        routed = {}
+        with self.lock:
+            for username, lines in message['batches'].items():
+                owner, status = self.owners.get(username, (None, "FLN"))
+                if status != "FLN":
+                    routed.setdefault(owner, {})[username] = lines
+        for owner, batches in routed.items():
+            owner.send({"op": "deliver", "kind": message['kind'], "batches": batches})
+
+class DirectoryPeer():
+    def __init__(self, connection):
+        self.connection = connection
+        self.owned = set()
+        self.lock = threading.Lock()
+    def send(self, message):
+        with self.lock:
+            try:
+                self.connection.sendall(encode(message))
+            except OSError:
+                pass
+
+class DirectoryClient(ProcessLocal):
+    # one connection per process to the DirectoryServer
+    def __init__(self, path=Configuration.directory_socket):
+        self.path = path
+        self.sock = None
+        self.unavailable = False # already reported, so a directory that is down is not reported once per request
+        self.lock = threading.Lock()
+        self.statuses = {} # username -> status for the users online in any process, replicated from the directory
+        self.resolver = lambda username: None
+        self.watchers_listener = lambda username: None
+
+    def set_resolver(self, resolver):
+        # resolver(username) returns this process's connection for {username}, or None
+        self.resolver = resolver
+
+    def set_watchers_listener(self, listener):
+        # listener(username) is called when another process changes who has {username} on their forward list
+        self.watchers_listener = listener
+
+    def connect(self):
+        # called when a server process starts, so its replica is filled before the first lookup
+        with self.lock:
+            self.ensure_connected()
+
+    def start_process(self):
+        # connections are per process, so a forked child opens its own
+        self.sock = None
+
+    def ensure_connected(self):
+        self.ensure_started()
+        if self.sock is None:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+            except OSError as e:
+                if not self.unavailable:
+                    sys.stderr.write(f"Session directory unavailable at {self.path}: {e}\n")
+                    self.unavailable = True
+                return False
+            self.sock = sock
+            self.unavailable = False
+            # the directory starts the new connection with every online user
+            self.statuses = {}
+            threading.Thread(target=self.read_loop, args=[sock], daemon=True).start()
+        return True
+
+    def request(self, message):
+        with self.lock:
+            if not self.ensure_connected():
+                return False
+            try:
+                self.sock.sendall(encode(message))
+                return True
+            except OSError:
+                self.sock = None
+                return False
+
+    def register(self, username, status):
+        self.request({"op": "register", "user": username, "status": status})
+
+    def unregister(self, username):
+        self.request({"op": "unregister", "user": username})
+
+    def set_status(self, username, status):
+        self.request({"op": "status", "user": username, "status": status})
+
+    def lookup(self, usernames):
+        # returns {username: status} for the users connected to any process; reads the local replica, so it
+        # never blocks, and a change made in another process shows up once the directory has passed it on
+        with self.lock:
+            self.ensure_connected()
+            statuses = self.statuses
+        found = {}
+        for username in usernames:
+            status = statuses.get(username)
+            if status is not None:
+                found[username] = status
+        return found
+
+    def watchers_changed(self, username):
+        self.request({"op": "watchers", "user": username})
+
+    def deliver(self, batches, kind="send"):
+        # batches is {username: [line, ...]}, or {username: {contact: line}} for "presence";
+        # each owning process sends the lines to its connection
+        if batches:
+            self.request({"op": "deliver", "kind": kind, "batches": batches})
+
+    def read_loop(self, sock):
+        statuses = self.statuses
+        try:
+            for line in sock.makefile('rb'):
+                message = json.loads(line)
+                match message['op']:
+                    case "presence":
+                        for username, status in message['statuses'].items():
+                            if status == "FLN":
+                                statuses.pop(username, None)
+                            else:
+                                statuses[username] = status
+                    case "watchers":
+                        self.watchers_listener(message['user'])
+                    case "deliver":
+                        self.deliver_locally(message['kind'], message['batches'])
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+                # nothing keeps the replica current any more
+                self.statuses = {}
+
+    def deliver_locally(self, kind, batches):
+        for username, lines in batches.items():
+            cn = self.resolver(username)
+            if cn is None:
+                continue
+            if kind == "presence":
+                cn.send_presence(lines)
+            else:
+                cn.send_multi_line(lines)
+
+class RemoteConnection():
+    # stands in for a connection owned by another process; writes are routed through the directory
+    def __init__(self, directory, username, status):
+        self.directory = directory
+        self.username = username
+        self.status = status
+    def send(self, string):
+        self.directory.deliver({self.username: [string]})
+    def send_multi_line(self, strings):
+        self.directory.deliver({self.username: list(strings)})
+    def error(self, errno, trid):
+        self.send(f"{errno} {trid}")
@@ -0,0 +1,78 @@
+from config import Configuration
+
+# commands whose header ends in the byte length of a payload that follows the \r\n
+PAYLOAD_COMMANDS = (b"MSG ", b"UUX ", b"QRY ")
+
+class FramingError(ValueError):
+    # the peer sent something that cannot be framed; the connection cannot be resynchronised and is closed
+    pass
+
+class CommandFramer():
+    def __init__(self, payload_commands=PAYLOAD_COMMANDS, max_line=Configuration.max_command_length, max_payload=Configuration.max_payload_length):
+        self.payload_commands = payload_commands
+        self.max_line = max_line
+        self.max_payload = max_payload
+        self.buffer = bytearray()
+        self.start = 0 # first byte of the command currently being framed
+        self.scan = 0 # where the search for the next \r\n resumes
+        self.pending = None # end offset of a payload that has not fully arrived
+
+    def feed(self, data):
+        # returns every command completed by {data}, decoded once, header and payload together
+        buf = self.buffer
+        buf += data
+        commands = []
+        with memoryview(buf) as view:
+            while True:
+                if self.pending is not None:
+                    if len(buf) < self.pending:
+                        break
+                    end = self.pending
+                    self.pending = None
+                else:
+                    eol = buf.find(b"\r\n", self.scan)
+                    if eol == -1:
+                        if len(buf) - self.start > self.max_line:
+                            raise FramingError("command line too long")
+                        self.scan = max(self.start, len(buf) - 1)
+                        break
+                    if eol - self.start > self.max_line:
+                        raise FramingError("command line too long")
+                    end = eol + 2
+                    if eol == self.start:
+                        # stray blank line
+                        self.start = self.scan = end
+                        continue
+                    length = self.payload_length(buf, self.start, eol)
+                    if length:
+                        end += length
+                        if len(buf) < end:
+                            self.pending = end
+                            break
+                commands.append(str(view[self.start:end], "utf-8", "replace"))
+                self.start = self.scan = end
+        self.compact()
+        return commands
+
+    def payload_length(self, buf, start, eol):
+        for cmd in self.payload_commands:
+            if buf.startswith(cmd, start, eol):
+                field = bytes(buf[buf.rfind(b" ", start, eol) + 1:eol])
+                # int() would also take a sign, spaces or underscores
+                if not field.isdigit():
+                    raise FramingError(f"malformed payload length {field!r}")
+                length = int(field)
+                if length > self.max_payload:
+                    raise FramingError(f"payload of {length} bytes is too long")
+                return length
+        return 0
+
+    def compact(self):
+        # drop consumed bytes once per feed so only the unfinished tail is ever moved
+        if self.start == 0:
+            return
+        del self.buffer[:self.start]
+        self.scan -= self.start
+        if self.pending is not None:
+            self.pending -= self.start
+        self.start = 0
@@ -1,20 +1,38 @@
-from tcp import TCPServer
+from tcp import TCPServer, AsyncTCPServer
 import msn_handler
 import auth.user_database
 import auth.login
+from auth.cached_database import CachedUserDatabase
 from config import Configuration
-from msn_patcher import ErrorPatcher
+from msn_patcher import ErrorPatcher, KeepAlivePatcher
 from multiprocessing import Process
 from switchboard.patcher import SwitchBoardFactory
+from notification_server.presence import Presence
+from directory import DirectoryServer, DirectoryClient
 
 def main():
     handler = msn_handler.MSNHandler
-    login_database = auth.user_database.MD5JSON(Configuration.user_database_file)
+    server = AsyncTCPServer if Configuration.server_mode == "asyncio" else TCPServer
+    login_database = auth.user_database.open_user_database(Configuration.user_database_file)
+    if Configuration.workers > 1 and not login_database.shared:
+        # each worker would change its own copy of a JSON or snapshot database
+        raise SystemExit(f"workers = {Configuration.workers} needs a user database several processes can write; use an SQLite user_database_file (.db)")
+    if Configuration.user_cache_size:
+        login_database = CachedUserDatabase(login_database)
+    if Configuration.directory_socket is not None:
+        directory_server = DirectoryServer()
+        directory_server.start()
+        directory_server.wait_ready()
+        login_database.set_directory(DirectoryClient())
     switchboard_factory = SwitchBoardFactory(login_database)
-    switchboard_server = TCPServer(handler, [switchboard_factory, ErrorPatcher], port=Configuration.SB_PORT)
+    metrics_port = Configuration.metrics_port
+    switchboard_server = server(handler, [switchboard_factory, ErrorPatcher], port=Configuration.SB_PORT,
+        metrics_port=None if metrics_port is None else metrics_port + Configuration.workers, idle_timeout=Configuration.sb_idle_timeout)
     login_database.set_switchboard((switchboard_server.ip, switchboard_server.port))
-    login_factory = auth.login.MD5LoginFactory(login_database)
-    notification_server = TCPServer(handler, [login_factory, ErrorPatcher])
+    presence = Presence(login_database)
+    login_factory = auth.login.MD5LoginFactory(login_database, presence)
+    notification_server = server(handler, [login_factory, KeepAlivePatcher, ErrorPatcher], workers=Configuration.workers,
+        metrics_port=metrics_port, idle_timeout=Configuration.idle_timeout)
 
     notification_server.start()
     switchboard_server.start()
@@ -0,0 +1,197 @@
+import bisect
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config import Configuration
+
+# in-process counters, gauges and histograms, exported in the Prometheus text format
+# every server process keeps its own values and serves them on its own port
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+def label_string(names, values, extra=""):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric():
+    kind = None
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.children = {} # label values -> child
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self.default = self.labels()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.child())
+        return child
+
+    def reset(self):
+        for child in list(self.children.values()):
+            child.reset()
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            lines.extend(self.expose_child(values, child))
+        return lines
+
+class Value():
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+    def set(self, value):
+        self.value = value
+    def reset(self):
+        self.value = 0
+
+class Counter(Metric):
+    kind = "counter"
+    def child(self):
+        return Value()
+    def inc(self, amount=1):
+        self.default.inc(amount)
+    def expose_child(self, values, child):
+        return [f"{self.name}{label_string(self.label_names, values)} {child.value}"]
+
+class Gauge(Counter):
+    kind = "gauge"
+    def dec(self, amount=1):
+        self.default.dec(amount)
+    def set(self, value):
+        self.default.set(value)
+
+class Buckets():
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+    def observe(self, value):
+        ix = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[ix] += 1
+            self.sum += value
+    def time(self):
+        return Timer(self)
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * len(self.counts)
+            self.sum = 0
+
+class Timer():
+    # with histogram.time(): ... observes the seconds spent in the block
+    def __init__(self, buckets):
+        self.buckets = buckets
+    def __enter__(self):
+        self.start = time.perf_counter()
+    def __exit__(self, exc_type, exc, tb):
+        self.buckets.observe(time.perf_counter() - self.start)
+
+class Histogram(Metric):
+    kind = "histogram"
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, description, labels)
+    def child(self):
+        return Buckets(self.buckets)
+    def observe(self, value):
+        self.default.observe(value)
+    def time(self):
+        return self.default.time()
+    def expose_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{label_string(self.label_names, values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{label_string(self.label_names, values)} {total}")
+        lines.append(f"{self.name}_count{label_string(self.label_names, values)} {cumulative}")
+        return lines
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+    def reset(self):
+        # a forked process starts counting from zero instead of inheriting its parent's values
+        for metric in list(self.metrics.values()):
+            metric.reset()
+    def expose(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, description, labels=()):
+    return REGISTRY.register(Counter(name, description, labels))
+
+def gauge(name, description, labels=()):
+    return REGISTRY.register(Gauge(name, description, labels))
+
+def histogram(name, description, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+LOCK_WAIT = histogram("msn_database_lock_wait_seconds", "Time spent waiting for a user database lock", ["lock", "mode"])
+
+class TimedLock():
+    # context manager that observes how long {lock}.acquire() waited
+    def __init__(self, lock, wait):
+        self.lock = lock
+        self.wait = wait
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.wait.observe(time.perf_counter() - start)
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        self.lock.release()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+def serve(ip=Configuration.metrics_ip, port=Configuration.metrics_port):
+    # exposes this process's metrics on http://{ip}:{port}/metrics from a daemon thread
+    try:
+        server = ThreadingHTTPServer((ip, port), MetricsHandler)
+    except OSError as e:
+        sys.stderr.write(f"Metrics unavailable on {ip}:{port}: {e}\n")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
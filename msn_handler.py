@@ -1,24 +1,77 @@
 import sys
-import inspect
+import time
+import threading
+import metrics
+
+COMMAND_SECONDS = metrics.histogram("msn_command_seconds", "Time spent handling each MSNP command", ["command"])
+UNKNOWN_COMMANDS = metrics.counter("msn_unknown_commands_total", "Commands with no handler")
+
+class DispatchTable():
+    # command -> (slot, function) for one sequence of patcher classes, where slot is the patcher's position
+    # built once per sequence and shared by every connection that reaches it
+    tables = {} # tuple of patcher classes -> DispatchTable
+    lock = threading.Lock()
+
+    def __init__(self, classes):
+        self.classes = classes
+        self.commands = {}
+        for slot, cls in enumerate(classes):
+            # names are looked up on the class, so a subclass that overrides a handler gets its own
+            for cmd, name in cls.commands.items():
+                self.commands[cmd] = (slot, getattr(cls, name))
+        self.extensions = {} # patcher class -> DispatchTable with it added
+
+    @classmethod
+    def of(cls, classes):
+        table = cls.tables.get(classes)
+        if table is None:
+            with cls.lock:
+                table = cls.tables.setdefault(classes, cls(classes))
+        return table
+
+    def extended(self, patcher_class):
+        table = self.extensions.get(patcher_class)
+        if table is None:
+            table = self.extensions.setdefault(patcher_class, DispatchTable.of(self.classes + (patcher_class,)))
+        return table
 
 class MSNHandler():
-    def __init__(self, func_table={}):
-        self.func_table = dict(func_table)
-    
+    # per-connection dispatch state: the shared table and the patchers its slots refer to
+    __slots__ = ('table', 'states')
+
+    def __init__(self):
+        self.table = DispatchTable.of(())
+        self.states = []
+
     def handle(self, raw_data):
         if raw_data == '':
             sys.stderr.write("Received NULL")
             return
-        components = raw_data.split()
+        # payload commands (MSG etc.) keep their payload intact as the last component
+        header, _, payload = raw_data.partition("\r\n")
+        components = header.split()
+        if payload:
+            components.append(payload)
         cmd = components.pop(0)
-        if cmd in self.func_table:
-            self.func_table[cmd](components)
+        entry = self.table.commands.get(cmd)
+        if entry is not None:
+            slot, func = entry
+            start = time.perf_counter()
+            try:
+                func(self.states[slot], components)
+            finally:
+                COMMAND_SECONDS.labels(cmd).observe(time.perf_counter() - start)
         else:
+            UNKNOWN_COMMANDS.inc()
             sys.stderr.write(f"Undefined function '{cmd}{components}'")
-            try:
-                self.func_table['error'](components)
-            except KeyError:
+            entry = self.table.commands.get('error')
+            if entry is None:
                 sys.stderr.write("No error function is defined. Consider adding one with a patcher entry for 'error'.")
+                return
+            slot, func = entry
+            func(self.states[slot], components)
 
-    def patch_functions(self, patched):
-        self.func_table.update(patched)
+    def add(self, state):
+        # a patcher's commands override those of the patchers added before it
+        self.table = self.table.extended(type(state))
+        self.states.append(state)
@@ -1,20 +1,33 @@
 import auth.errors
 
 class MSNPatcher():
+    # patchers hold a connection's state; their handlers are looked up once per class through {commands}
+    __slots__ = ('connection',)
+    commands = {} # command -> name of a method taking (self, data)
     def __init__(self, connection):
-        self.func_table = {}
         self.connection = connection
     def patch(self, handler):
-        handler.patch_functions(self.func_table)
-    # patching functions should have signature FUNC(self, data)
+        handler.add(self)
+    def close(self):
+        # called once when the connection goes away
+        pass
+
+class KeepAlivePatcher(MSNPatcher):
+    # clients send PNG every so often; answering it is also what keeps the idle timeout from firing
+    __slots__ = ()
+    commands = {
+        "PNG": "ping"
+    }
+
+    def ping(self, data):
+        self.connection.send("QNG")
 
 class ErrorPatcher(MSNPatcher):
-    def __init__(self, connection):
-        super().__init__(connection)
-        self.func_table = {
-            "error": self.__error__
-        }
-    
+    __slots__ = ()
+    commands = {
+        "error": "__error__"
+    }
+
     def __error__(self, data):
         if len(data) >= 1:
-            self.connection.error(auth.errors.GENERIC, data[0])
\ No newline at end of file
+            self.connection.error(auth.errors.GENERIC, data[0])
@@ -0,0 +1,132 @@
+import sys
+import threading
+from list_numbers import ListNumbers
+from process_local import ProcessLocal
+
+class Presence(ProcessLocal):
+    # single status table for the notification server plus an index of who watches whom
+    # status changes are queued and fanned out by one thread, batched per recipient
+    def __init__(self, database):
+        self.database = database
+        self.statuses = {} # username -> status, online users only
+        self.watchers = {} # username -> usernames with {username} on their forward list
+        self.pending = {} # username -> latest status not yet fanned out
+        self.generation = 0 # bumped whenever another process changes the watchers of someone
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.fanout = None
+        if database.directory is not None:
+            database.directory.set_watchers_listener(self.forget_watchers)
+
+    def start_process(self):
+        # started lazily so the thread lives in the server process, not the one that built it
+        self.fanout = threading.Thread(target=self.fanout_loop, daemon=True)
+        self.fanout.start()
+
+    def get_status(self, username):
+        return self.get_statuses([username]).get(username, "FLN")
+
+    def get_statuses(self, usernames):
+        # returns {username: status} for the online users among {usernames}, asking the directory once for the rest
+        statuses = {}
+        remote = []
+        for username in usernames:
+            if username in self.statuses:
+                statuses[username] = self.statuses[username]
+            else:
+                remote.append(username)
+        if remote and self.database.directory is not None:
+            for username, status in self.database.directory.lookup(remote).items():
+                if status != "FLN":
+                    statuses[username] = status
+        return statuses
+
+    def set_status(self, username, status):
+        with self.lock:
+            if status == "FLN":
+                self.statuses.pop(username, None)
+            else:
+                self.statuses[username] = status
+            # only the latest status matters if several arrive before the fan-out runs
+            self.pending[username] = status
+        if self.database.directory is not None:
+            self.database.directory.set_status(username, status)
+        self.ensure_started()
+        self.wakeup.set()
+
+    def watchers_of(self, username):
+        watchers = self.watchers.get(username)
+        if watchers is None:
+            generation = self.generation
+            loaded = {c.username for c in self.database.get_contacts_from_list(username, ListNumbers.REVERSE_LIST)}
+            with self.lock:
+                # a load that raced a change made in another process is used once but not kept
+                if self.generation != generation:
+                    return loaded
+                watchers = self.watchers.setdefault(username, loaded)
+        return watchers
+
+    def subscribe(self, watcher, username):
+        # an index that has not been loaded yet will pick the change up from the reverse list
+        with self.lock:
+            if username in self.watchers:
+                self.watchers[username].add(watcher)
+        self.watchers_changed(username)
+
+    def unsubscribe(self, watcher, username):
+        with self.lock:
+            if username in self.watchers:
+                self.watchers[username].discard(watcher)
+        self.watchers_changed(username)
+
+    def watchers_changed(self, username):
+        # the other processes reload their index for {username} from the reverse list the change was written to
+        if self.database.directory is not None:
+            self.database.directory.watchers_changed(username)
+
+    def forget_watchers(self, username):
+        with self.lock:
+            self.generation += 1
+            self.watchers.pop(username, None)
+
+    def fanout_loop(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+            # one failed batch (a database error, a broken connection) must not stop every later status change
+            try:
+                self.fan_out(pending)
+            except Exception as e:
+                sys.stderr.write(f"Presence fan-out of {len(pending)} status changes failed: {e}\n")
+
+    def fan_out(self, pending):
+        batches = {}
+        remote = {}
+        for username, status in pending.items():
+            if status in ("FLN", "HDN"):
+                line = f"FLN {username}"
+            else:
+                line = f"NLN {status} {username} {self.database.get_nickname(username)}"
+            watchers = self.watchers_of(username)
+            with self.lock:
+                watchers = list(watchers)
+            # keyed by whose status it is, so a slow watcher can keep just the latest one
+            for watcher in watchers:
+                if watcher in self.statuses:
+                    batches.setdefault(watcher, {})[username] = line
+                elif self.database.directory is not None:
+                    # may be online in another process; the directory drops lines for offline users
+                    remote.setdefault(watcher, {})[username] = line
+        for watcher, updates in batches.items():
+            cn = self.database.get_local_connection(watcher)
+            if cn is not None:
+                try:
+                    cn.send_presence(updates)
+                except OSError:
+                    # the watcher is disconnecting; its own connection cleans up
+                    pass
+        if remote:
+            self.database.directory.deliver(remote, kind="presence")
@@ -2,9 +2,10 @@ from msn_patcher import MSNPatcher
 from list_numbers import ListNumbers
 from abc import abstractmethod
 from auth.errors import *
-from config import Configuration
+from switchboard.tickets import signed_ticket
 
 class Synchroniser(MSNPatcher):
+    __slots__ = ()
     @abstractmethod
     def return_syn(self, data):
         pass
@@ -22,28 +23,69 @@ class Synchroniser(MSNPatcher):
         pass
 
 class SynchroniserMSNP6(Synchroniser):
-    def __init__(self, database, connection):
+    __slots__ = ('database', 'presence', 'list_ver')
+    commands = {
+        "SYN": "return_syn",
+        "CHG": "change_status",
+        "ADD": "add_contact",
+        "REM": "remove_contact",
+        "XFR": "transfer"
+    }
+
+    def __init__(self, database, presence, connection):
         super().__init__(connection)
         self.database = database
+        self.presence = presence
         self.list_ver = 0
-        self.func_table = {
-            "SYN": self.return_syn,
-            "CHG": self.change_status,
-            "ADD": self.add_contact,
-            "REM": self.remove_contact,
-            "XFR": self.transfer,
-            'change-status': self.relay_status_update
-        }
 
     def return_syn(self, data):
-        # for now we will always pretend we have more up to date contact info since it makes synchronisation easier
         trid = data[0]
-        self.list_ver = int(data[1])+1
+        client_ver = int(data[1])
+        username = self.connection.username
+        self.list_ver = self.database.get_list_version(username)
         self.connection.send(f"SYN {trid} {self.list_ver}")
+        if client_ver == self.list_ver:
+            # client's cached lists are up to date
+            return
+        changes = None
+        if 0 < client_ver < self.list_ver:
+            changes = self.database.get_list_changes(username, client_ver)
+        if changes is None:
+            # client is too far behind the change log (or has nothing cached): full dump
+            self.send_lists(trid)
+        else:
+            self.send_changes(trid, changes)
+
+    def send_lists(self, trid):
         self.send_privacy_settings(trid)
         self.send_phone_info(trid)
         self.send_contacts(trid)
 
+    def replays(self, change):
+        # group changes (ADG, RMG, and ADD/REM with a group id) mean nothing before MSNP7; an MSNP6 client
+        # would read a group REM as taking the contact off the whole list
+        cmd, args = change[1], change[2:]
+        return cmd in ("ADD", "REM") and len(args) == 2
+
+    def send_changes(self, trid, changes):
+        for change in changes:
+            if not self.replays(change):
+                continue
+            ver, cmd, *args = change
+            match cmd:
+                case "ADD":
+                    list_num, contact_name, *group = args
+                    nickname = self.database.get_nickname(contact_name)
+                    self.connection.send(" ".join(str(x) for x in ["ADD", trid, list_num, ver, contact_name, nickname, *group]))
+                case "REM":
+                    list_num, contact_name, *group = args
+                    self.connection.send(" ".join(str(x) for x in ["REM", trid, list_num, ver, contact_name, *group]))
+                case "ADG":
+                    groupname, groupnum = args
+                    self.connection.send(f"ADG {trid} {ver} {groupname} {groupnum} 0")
+                case "RMG":
+                    self.connection.send(f"RMG {trid} {ver} {args[0]}")
+
     def transfer(self, data):
         trid = data[0]
         dest = data[1]
@@ -54,8 +96,10 @@ class SynchroniserMSNP6(Synchroniser):
     
     def transfer_to_switchboard(self, trid):
         sb_ip, sb_port = self.database.get_switchboard()
-        # use same auth string for everyone for now
-        self.connection.send(f"XFR {trid} SB {sb_ip}:{sb_port} CKI {Configuration.sb_auth_string}")
+        # the switchboard runs in another process and checks the signature itself, so nothing is sent to it first
+        username = self.connection.username
+        ticket = signed_ticket(username, self.database.get_nickname(username))
+        self.connection.send(f"XFR {trid} SB {sb_ip}:{sb_port} CKI {ticket}")
 
     def send_privacy_settings(self, trid):
         # for now everyone gets the same privacy settings
@@ -78,35 +122,40 @@ class SynchroniserMSNP6(Synchroniser):
                 self.connection.send(f"LST {trid} {t} {self.list_ver} 0 0")
             else:
                 for ix, c in enumerate(lists[t]):
-                    self.connection.send(f"LST {trid} {t} {self.list_ver} {ix+1} {size} {c.username} {c.nickname}")
+                    self.connection.send(self.contact_line(trid, t, ix, size, c))
+
+    def contact_line(self, trid, list_num, ix, size, contact):
+        return f"LST {trid} {list_num} {self.list_ver} {ix+1} {size} {contact.username} {contact.nickname}"
 
     def change_status(self, data):
         trid = data[0]
         status = data[1]
-        for k in self.database.get_contacts_from_list(self.connection.username, ListNumbers.FORWARD_LIST):
-            cn = self.database.get_connection_for_user(k)
-            if cn is not None:
-                cn.tell(f'change-status {self.connection.username} {status}')
+        first = self.connection.status == "FLN"
+        # watchers are notified by the presence fan-out thread, so CHG does not wait on them
+        self.presence.set_status(self.connection.username, status)
         self.connection.status = status
         self.connection.send(f"CHG {trid} {status}")
-        self.get_statuses(trid)
+        if first:
+            self.get_statuses(trid)
 
     def get_statuses(self, trid):
-        for k in self.database.get_contacts_from_list(self.connection.username, ListNumbers.FORWARD_LIST):
-            cn = self.database.get_connection_for_user(k)
+        lines = []
+        contacts = self.database.get_contacts_from_list(self.connection.username, ListNumbers.FORWARD_LIST)
+        statuses = self.presence.get_statuses([k.username for k in contacts])
+        for k in contacts:
+            status = statuses.get(k.username, "FLN")
             if k.username.split("@")[1] == "signal.com": #FIXME: remove hardcoded signal.com
-                self.connection.send(f"ILN {trid} NLN {k.username} {k.nickname}")
-            elif cn is not None:
-                self.connection.send(f"ILN {trid} {cn.status} {k.username} {k.nickname}")
+                lines.append(f"ILN {trid} NLN {k.username} {k.nickname}")
+            elif status not in ("FLN", "HDN"):
+                lines.append(f"ILN {trid} {status} {k.username} {k.nickname}")
+        if lines:
+            self.connection.send_multi_line(lines)
+
+    def close(self):
+        # a connection replaced by a newer login of the same user leaves its presence alone
+        if self.database.remove_connection_for_user(self.connection, self.connection.username) and self.connection.status != "FLN":
+            self.presence.set_status(self.connection.username, "FLN")
 
-    def relay_status_update(self, data):
-        contact_name = data[0]
-        status = data[1]
-        if status == "FLN":
-            self.connection.send(f"FLN {contact_name}")
-        else:
-            self.connection.send(f"NLN {status} {contact_name} {self.database.get_nickname(contact_name)}")
-    
     def add_contact(self, data):
         trid = data[0]
         list_num = data[1]
@@ -118,7 +167,9 @@ class SynchroniserMSNP6(Synchroniser):
             return
         result = self.database.add_contact_to_list(self.connection.username, username, list_num)
         if result == SUCCESS:
-            self.list_ver += 1
+            if list_num == ListNumbers.FORWARD_LIST:
+                self.presence.subscribe(self.connection.username, username)
+            self.list_ver = self.database.get_list_version(self.connection.username)
             self.connection.send(f"ADD {trid} {list_num} {self.list_ver} {username} {nickname}")
         else:
             self.connection.error(result, trid)
@@ -133,23 +184,110 @@ class SynchroniserMSNP6(Synchroniser):
             return
         result = self.database.remove_contact_from_list(self.connection.username, username, list_num)
         if result == SUCCESS:
-            self.list_ver += 1
+            if list_num == ListNumbers.FORWARD_LIST:
+                self.presence.unsubscribe(self.connection.username, username)
+            self.list_ver = self.database.get_list_version(self.connection.username)
             self.connection.send(f"REM {trid} {list_num} {self.list_ver} {username}")
         else:
             self.connection.error(result, trid)
 
 
 class SynchroniserMSNP7(SynchroniserMSNP6):
-    #TODO
+    # MSNP7 adds contact groups: LSG in the SYN dump, group ids on FL entries, ADG/RMG, and ADD/REM with a group id
+    __slots__ = ()
+    commands = {
+        **SynchroniserMSNP6.commands,
+        "ADG": "add_group",
+        "RMG": "remove_group"
+    }
+
+    def send_lists(self, trid):
+        self.send_privacy_settings(trid)
+        self.send_phone_info(trid)
+        self.send_groups(trid, self.list_ver)
+        self.send_contacts(trid)
+
+    def replays(self, change):
+        return True
+
     def send_groups(self, trid, list_ver):
-        group_names = self.database.get_group_names(self.connection.username)
+        # removed groups leave gaps in the numbering
+        groups = [(groupnum, name) for groupnum, name in enumerate(self.database.get_group_names(self.connection.username)) if name is not None]
         group_strings = []
-        for ix, g in enumerate(group_names):
-            group_strings.append(f"LSG {trid} {list_ver} {ix+1} {len(group_names)} {ix} {g} 0")
+        for ix, (groupnum, name) in enumerate(groups):
+            group_strings.append(f"LSG {trid} {list_ver} {ix+1} {len(groups)} {groupnum} {name} 0")
         self.connection.send_multi_line(group_strings)
 
+    def contact_line(self, trid, list_num, ix, size, contact):
+        line = super().contact_line(trid, list_num, ix, size, contact)
+        if list_num != ListNumbers.FORWARD_LIST:
+            return line
+        return f"{line} {','.join(str(g) for g in contact.groups or [0])}"
+
+    def add_group(self, data):
+        trid = data[0]
+        groupname = data[1]
+        groupnum = self.database.new_group(self.connection.username, groupname)
+        if groupnum is None:
+            self.connection.error(GROUP_ALREADY_EXISTS, trid)
+            return
+        self.list_ver = self.database.get_list_version(self.connection.username)
+        self.connection.send(f"ADG {trid} {self.list_ver} {groupname} {groupnum} 0")
+
+    def remove_group(self, data):
+        trid = data[0]
+        groupnum = int(data[1])
+        if groupnum == 0:
+            self.connection.error(CANNOT_REMOVE_GROUP_ZERO, trid)
+        elif self.database.del_group(self.connection.username, groupnum):
+            self.list_ver = self.database.get_list_version(self.connection.username)
+            self.connection.send(f"RMG {trid} {self.list_ver} {groupnum}")
+        else:
+            self.connection.error(INVALID_GROUP, trid)
+
+    def add_contact(self, data):
+        # "ADD trid FL user nickname groupid" files a contact already on the forward list under another group
+        if data[1] != ListNumbers.FORWARD_LIST or len(data) < 5:
+            super().add_contact(data)
+            return
+        trid, list_num, username, nickname, groupnum = data[:5]
+        if not '@' in username:
+            self.connection.error(MALFORMED_EMAIL, trid)
+            return
+        # a contact not on the forward list yet is added to it (and group 0) first
+        result = self.database.add_contact_to_list(self.connection.username, username, list_num)
+        if result == SUCCESS:
+            self.presence.subscribe(self.connection.username, username)
+        elif result != USER_ALREADY_IN_LIST:
+            self.connection.error(result, trid)
+            return
+        if int(groupnum) != 0 and not self.database.add_to_group(self.connection.username, int(groupnum), username):
+            self.connection.error(INVALID_GROUP, trid)
+            return
+        self.list_ver = self.database.get_list_version(self.connection.username)
+        self.connection.send(f"ADD {trid} {list_num} {self.list_ver} {username} {nickname} {groupnum}")
+
+    def remove_contact(self, data):
+        # "REM trid FL user groupid" only takes the contact out of that group
+        if data[1] != ListNumbers.FORWARD_LIST or len(data) < 4:
+            super().remove_contact(data)
+            return
+        trid, list_num, username, groupnum = data[:4]
+        if not self.database.remove_from_group(self.connection.username, int(groupnum), username):
+            self.connection.error(USER_NOT_IN_GROUP, trid)
+            return
+        self.list_ver = self.database.get_list_version(self.connection.username)
+        self.connection.send(f"REM {trid} {list_num} {self.list_ver} {username} {groupnum}")
+
+# the synchroniser each negotiated protocol version gets; anything older than MSNP7 has no groups
+SYNCHRONISERS = {
+    "MSNP7": SynchroniserMSNP7
+}
+
 class SynchroniserFactory():
-    def __init__(self, database):
+    def __init__(self, database, presence):
         self.database = database
+        self.presence = presence
     def __call__(self, connection):
-        return SynchroniserMSNP6(self.database, connection)
\ No newline at end of file
+        synchroniser = SYNCHRONISERS.get(connection.protocol, SynchroniserMSNP6)
+        return synchroniser(self.database, self.presence, connection)
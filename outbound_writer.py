@@ -0,0 +1,78 @@
+import selectors
+import socket
+import sys
+import threading
+from process_local import ProcessLocal
+
+# one thread per process finishes the writes that did not fit in a client's socket buffer
+# connections send straight from the calling thread while their queue is empty and hand the socket
+# over here otherwise, so a client that stops reading only ever holds up its own queue
+
+class OutboundWriter(ProcessLocal):
+    def __init__(self):
+        self.selector = None
+        self.wakeup = None
+        self.changes = [] # ("add" | "remove", connection), applied by the writer thread in order
+        self.lock = threading.Lock()
+
+    def start_process(self):
+        # selectors and socketpairs do not survive fork, so each process builds its own
+        self.selector = selectors.DefaultSelector()
+        self.wakeup = socket.socketpair()
+        self.wakeup[0].setblocking(False)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ, None)
+        self.changes = []
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def change(self, op, connection):
+        self.ensure_started()
+        with self.lock:
+            self.changes.append((op, connection))
+        try:
+            self.wakeup[1].send(b"\0")
+        except BlockingIOError:
+            pass # already woken
+
+    def add(self, connection):
+        # connection.flush_outbound() is called whenever its socket can take more
+        self.change("add", connection)
+
+    def remove(self, connection):
+        # must happen before the socket is closed, or a new socket reusing the descriptor could be missed
+        self.change("remove", connection)
+
+    def apply_changes(self):
+        with self.lock:
+            changes, self.changes = self.changes, []
+        for op, connection in changes:
+            try:
+                if op == "add":
+                    self.selector.register(connection.connection, selectors.EVENT_WRITE, connection)
+                else:
+                    self.selector.unregister(connection.connection)
+            except (KeyError, ValueError):
+                pass # already registered, or already gone
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    try:
+                        while key.fileobj.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    drained = key.data.flush_outbound()
+                except Exception as e:
+                    sys.stderr.write(f"Outbound flush for {key.data.client_address} failed: {e}\n")
+                    drained = True
+                if drained:
+                    try:
+                        self.selector.unregister(key.fileobj)
+                    except (KeyError, ValueError):
+                        pass
+            self.apply_changes()
+
+WRITER = OutboundWriter()
@@ -0,0 +1,31 @@
+import os
+import threading
+
+# threads, sockets and connections do not survive a fork, so objects that need them build them lazily
+# in the process that first uses them; ensure_started() calls start_process() once per process
+
+LOCK = threading.RLock() # reentrant: one object's start_process() may start another's
+
+def reset_lock():
+    # the fork may have happened while another thread held it
+    global LOCK
+    LOCK = threading.RLock()
+
+os.register_at_fork(after_in_child=reset_lock)
+
+class ProcessLocal():
+    pid = None # process start_process() last ran in
+
+    def ensure_started(self):
+        if self.pid != os.getpid():
+            with LOCK:
+                if self.pid != os.getpid():
+                    self.start_process()
+                    # set afterwards, so a start that raised is tried again by the next caller
+                    self.pid = os.getpid()
+
+    def started_here(self):
+        return self.pid == os.getpid()
+
+    def start_process(self):
+        raise NotImplementedError
@@ -0,0 +1,139 @@
+import itertools
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from config import Configuration
+from process_local import ProcessLocal
+
+# protocol trace: connections append records to a bounded in-memory ring (deque appends need no lock)
+# and a background thread formats and writes them, so tracing never does I/O on a connection's thread
+# which connections are traced is decided by sampling, a username filter or a client address filter
+# the filters can be changed at runtime through Configuration.trace_filter_file, one rule per line:
+#   user alice@example.com
+#   address 10.0.0.7        (or 10.0.0.7:51234 for one connection)
+#   sample 0.01
+# kill -USR1 <pid> dumps the whole ring of that process to Configuration.trace_dump_file
+
+class Tracer(ProcessLocal):
+    def __init__(self, capacity=Configuration.trace_buffer_size, output=Configuration.trace_file,
+                 flush_interval=Configuration.trace_flush_interval, filter_file=Configuration.trace_filter_file,
+                 dump_file=Configuration.trace_dump_file):
+        self.records = deque(maxlen=capacity) # (seq, time, local port, client address, username, event, data)
+        self.seq = itertools.count()
+        # file name, "-" for stdout, or None to keep records only in the ring; debug traces everything to stdout
+        self.output = "-" if output is None and Configuration.debug else output
+        self.flush_interval = flush_interval
+        self.filter_file = filter_file
+        self.filter_mtime = None
+        self.dump_file = dump_file
+        self.everything = Configuration.debug
+        self.sample = Configuration.trace_sample
+        self.users = set(Configuration.trace_users)
+        self.addresses = set()
+        self.written = -1 # seq of the last record handed to the output
+        self.writer = None
+
+    def start_process(self):
+        # the writer lives in the process doing the tracing, not the one that imported this module
+        self.records.clear()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def sample_connection(self):
+        # decided once per connection, so a sampled connection is traced from start to finish
+        return self.everything or (self.sample > 0 and random.random() < self.sample)
+
+    def wants(self, connection):
+        if connection.sampled:
+            return True
+        if self.users and connection.username in self.users:
+            return True
+        if self.addresses and connection.client_address:
+            ip, port = connection.client_address[:2]
+            return ip in self.addresses or f"{ip}:{port}" in self.addresses
+        return False
+
+    def record(self, connection, event, data):
+        # {data} is kept as given (bytes or str) and only formatted by the writer
+        self.records.append((next(self.seq), time.time(), connection.local_port(), connection.client_address, connection.username, event, data))
+
+    def format(self, record):
+        seq, when, port, address, username, event, data = record
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", "replace")
+        stamp = time.strftime("%H:%M:%S", time.localtime(when))
+        return f"{stamp}.{int(when % 1 * 1000):03d} {port} {address} {username or '-'} {event} {data!r}\n"
+
+    def pending(self):
+        # records not yet written, oldest first; anything that fell off the ring in between is lost
+        return [r for r in self.records.copy() if r[0] > self.written]
+
+    def write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            # a bad filter file or an unwritable output must not stop tracing for good
+            try:
+                self.load_filters()
+                if self.output is not None:
+                    self.flush()
+            except Exception as e:
+                sys.stderr.write(f"Protocol trace write failed: {e}\n")
+
+    def flush(self):
+        records = self.pending()
+        if not records:
+            return
+        self.written = records[-1][0]
+        text = "".join(self.format(r) for r in records)
+        if self.output == "-":
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        else:
+            with open(self.output, 'a') as f:
+                f.write(text)
+
+    def dump(self, path=None):
+        # writes the whole ring, including records already flushed
+        path = path or self.dump_file.format(pid=os.getpid())
+        records = self.records.copy()
+        with open(path, 'w') as f:
+            f.writelines(self.format(r) for r in records)
+        return path
+
+    def load_filters(self):
+        if self.filter_file is None:
+            return
+        try:
+            mtime = os.stat(self.filter_file).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.filter_mtime:
+            return
+        self.filter_mtime = mtime
+        users = set(Configuration.trace_users)
+        addresses = set()
+        sample = Configuration.trace_sample
+        if mtime is not None:
+            with open(self.filter_file, 'r') as f:
+                for line in f:
+                    kind, _, value = line.strip().partition(" ")
+                    match kind:
+                        case "user":
+                            users.add(value.strip())
+                        case "address":
+                            addresses.add(value.strip())
+                        case "sample":
+                            sample = float(value)
+        self.users = users
+        self.addresses = addresses
+        self.sample = sample
+
+    def install_dump_signal(self):
+        # must be called from the process's main thread
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=self.dump, daemon=True).start())
+
+TRACER = Tracer()
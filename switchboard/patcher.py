@@ -1,80 +1,142 @@
 from msn_patcher import MSNPatcher
 from auth.errors import *
-from config import Configuration
-from random import randint
-from switchboard.signal import Signal
+from switchboard.session import SessionRegistry
+from switchboard.tickets import TicketTable
+from switchboard.transport import SignalSender, SignalReceiver, create_transport
+
+def content_type(headers):
+    for line in headers.split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-type":
+            return value.strip()
+    return None
 
 class SwitchBoard(MSNPatcher):
+    __slots__ = ('database', 'sessions', 'tickets', 'signal_sender', 'signal_receiver', 'session', 'nickname')
+    commands = {
+        "USR": "authenticate",
+        "ANS": "answer",
+        "CAL": "call_user",
+        "MSG": "handle_message",
+        "OUT": "leave"
+    }
 
-    def __init__(self, database, connection):
+    def __init__(self, database, sessions, tickets, signal_sender, signal_receiver, connection):
         super().__init__(connection)
         self.database = database
-        self.contacts = []
-        self.signals = {}
-        self.sb_id = randint(100, 99999999)
-        self.func_table = {
-            "USR": self.authenticate,
-            "CAL": self.call_user,
-            "MSG": self.handle_message
-        }
+        self.sessions = sessions
+        self.tickets = tickets
+        self.signal_sender = signal_sender
+        self.signal_receiver = signal_receiver
+        self.session = None
+        self.nickname = None
+
+    def check_credentials(self, username, ticket, sb_id=None):
+        # tickets carry the nickname, so logging in here never touches the database
+        nickname = self.tickets.redeem(ticket, username, sb_id)
+        if nickname is None:
+            return False
+        self.connection.username = username
+        self.nickname = nickname
+        return True
 
     def authenticate(self, data):
         trid = data[0]
         username = data[1]
-        auth_token = data[2]
-        if self.database.check_username(username) and auth_token == Configuration.sb_auth_string:
-            nickname = self.database.get_nickname(username)
-            self.connection.send(f"USR {trid} OK {username} {nickname}")
+        ticket = data[2]
+        if self.check_credentials(username, ticket):
+            self.session = self.sessions.create()
+            self.session.join(username, self.nickname, self.connection)
+            self.connection.send(f"USR {trid} OK {username} {self.nickname}")
         else:
             self.connection.send(f"{INVALID_CREDENTIALS} {trid}")
 
+    def answer(self, data):
+        # an invited MSN user joining an existing session after RNG
+        trid = data[0]
+        username = data[1]
+        ticket = data[2]
+        session = self.sessions.get(int(data[3]))
+        if session is None or not self.check_credentials(username, ticket, session.sb_id):
+            self.connection.send(f"{INVALID_CREDENTIALS} {trid}")
+            return
+        roster = session.roster()
+        self.connection.send_multi_line([f"IRO {trid} {ix+1} {len(roster)} {u} {n}" for ix, (u, n) in enumerate(roster)])
+        self.session = session
+        session.join(username, self.nickname, self.connection)
+        self.connection.send(f"ANS {trid} OK")
+
+    def in_session(self, trid):
+        # MSG and CAL need the session USR or ANS puts the client in; a client that skips that is dropped
+        if self.session is not None:
+            return True
+        self.connection.error(NOT_EXPECTED, trid)
+        self.connection.shutdown()
+        return False
+
     def call_user(self, data):
         trid = data[0]
         contact = data[1]
+        if not self.in_session(trid):
+            return
         k = self.database.get_connection_for_user(contact)
-        self.contacts.append(contact)
         if contact.split('@')[1] == "signal.com": #FIXME: remove hardcoded signal.com
-            self.connection.send(f"CAL {trid} RINGING {self.sb_id}")
+            self.connection.send(f"CAL {trid} RINGING {self.session.sb_id}")
             nickname = self.database.get_nickname(contact)
-            self.signals[contact.split('@')[0]] = Signal(contact.split('@')[0], self)
-            self.signals[contact.split('@')[0]].start()
-            self.connection.send(f"JOI {contact} {nickname}")
+            number = contact.split('@')[0]
+            if self.session.add_signal(number, nickname):
+                # the shared receive loop routes messages from {number} to this session from now on
+                self.signal_receiver.register(number, self.session)
+                self.session.announce(contact, nickname)
         elif k is not None:
             addr = self.connection.get_address()
-            nickname = self.database.get_nickname(self.connection.username)
-            k.send(f"RNG {self.sb_id} {addr[0]}:{addr[1]} CKI {Configuration.sb_auth_string} {self.connection.username} {nickname}")
-            self.connection.send(f"CAL {trid} RINGING {self.sb_id}")
+            ticket = self.tickets.issue(contact, self.database.get_nickname(contact), self.session.sb_id)
+            k.send(f"RNG {self.session.sb_id} {addr[0]}:{addr[1]} CKI {ticket} {self.connection.username} {self.nickname}")
+            self.connection.send(f"CAL {trid} RINGING {self.session.sb_id}")
         else:
             self.connection.send(f"{USER_OFFLINE} {trid}")
 
     def handle_message(self, data):
-        #FIXME: remove magic numbers and magic strings
         trid = data[0]
-        length = data[2]
-        print("data: ", data)
-        if data[6] == 'text/x-msmsgscontrol':
+        ack = data[1]
+        if not self.in_session(trid):
             return
-        ix = data.index("PF=0") + 1
-        msg = ''.join(f"{x} " for x in data[ix:])
-        for c in self.contacts:
-            if c.split('@')[1] == "signal.com":
-                self.signals[c.split('@')[0]].send(msg)
-            #TODO: implement for MSN
-        self.connection.send(f"ACK {trid}")
-                
-    def send(self, msg, from_number):
-        #FIXME: remove magic numbers and magic strings
-        uname = f"{from_number}@signal.com"
-        nickname = self.database.get_nickname(uname)
-        length = 114 + len(msg)
-        self.connection.send(f"MSG {uname} {nickname} {length}\r\nMIME-Version: 1.0\r\nContent-Type: text/plain; charset=UTF-8\r\nX-MMS-IM-Format: FN=Arial; EF=I; CO=0; CS=0; PF=22\r\n\r\n{msg}")
+        payload = data[3] if len(data) > 3 else ""
+        headers, _, body = payload.partition("\r\n\r\n")
+        # encoded once, then the same bytes go to every other MSN participant
+        encoded = payload.encode("utf-8")
+        self.session.broadcast(self.connection.username, f"MSG {self.connection.username} {self.nickname} {len(encoded)}\r\n".encode("utf-8") + encoded)
+        delivered = True
+        if (content_type(headers) or "").startswith("text/plain"):
+            for number in list(self.session.signals):
+                delivered = self.signal_sender.send(number, body) and delivered
+        if not delivered:
+            self.connection.send(f"NAK {trid}")
+        elif ack != "U":
+            self.connection.send(f"ACK {trid}")
+
+    def leave(self, data=None):
+        if self.session is not None:
+            if self.session.leave(self.connection.username) == 0:
+                self.sessions.remove(self.session.sb_id)
+                for number in list(self.session.signals):
+                    self.signal_receiver.unregister(number, self.session)
+            self.session = None
 
-    def __del__(self):
-        for k in self.signals:
-            k.join()
+    def close(self):
+        self.leave()
 
 class SwitchBoardFactory():
-    def __init__(self, database):
+    def __init__(self, database, transport=None):
         self.database = database
+        self.sessions = SessionRegistry()
+        self.tickets = TicketTable()
+        transport = transport or create_transport()
+        self.signal_sender = SignalSender(transport)
+        self.signal_receiver = SignalReceiver(transport)
+    def start(self):
+        # runs in the switchboard process: fills its directory replica before the first CAL looks a user up
+        if self.database.directory is not None:
+            self.database.directory.connect()
     def __call__(self, connection):
-        return SwitchBoard(self.database, connection)
\ No newline at end of file
+        return SwitchBoard(self.database, self.sessions, self.tickets, self.signal_sender, self.signal_receiver, connection)
@@ -0,0 +1,80 @@
+import threading
+from random import randint
+
+TEXT_HEADERS = "MIME-Version: 1.0\r\nContent-Type: text/plain; charset=UTF-8\r\nX-MMS-IM-Format: FN=Arial; EF=I; CO=0; CS=0; PF=22\r\n\r\n"
+
+class Session():
+    # one switchboard conversation shared by every participant's connection
+    def __init__(self, sb_id):
+        self.sb_id = sb_id
+        self.participants = {} # username -> (nickname, connection) for MSN participants
+        self.signals = {} # number -> nickname for signal.com participants
+        self.lock = threading.Lock()
+
+    def roster(self):
+        with self.lock:
+            return [(u, n) for u, (n, _) in self.participants.items()] + [(f"{k}@signal.com", n) for k, n in self.signals.items()]
+
+    def add_signal(self, number, nickname):
+        # returns False if {number} is already part of the session
+        with self.lock:
+            if number in self.signals:
+                return False
+            self.signals[number] = nickname
+            return True
+
+    def receive_signal(self, number, message):
+        # called from the shared Signal receive loop
+        username = f"{number}@signal.com"
+        payload = f"{TEXT_HEADERS}{message}".encode("utf-8")
+        self.broadcast(username, f"MSG {username} {self.signals.get(number, username)} {len(payload)}\r\n".encode("utf-8") + payload)
+
+    def join(self, username, nickname, connection):
+        with self.lock:
+            others = [cn for _, cn in self.participants.values()]
+            self.participants[username] = (nickname, connection)
+        line = f"JOI {username} {nickname}\r\n".encode("utf-8")
+        for cn in others:
+            cn.write(line)
+
+    def announce(self, username, nickname):
+        # a non-MSN participant (e.g. a Signal contact) joining the conversation
+        line = f"JOI {username} {nickname}\r\n".encode("utf-8")
+        self.broadcast(None, line)
+
+    def leave(self, username):
+        with self.lock:
+            if self.participants.pop(username, None) is None:
+                return len(self.participants)
+            remaining = len(self.participants)
+        self.broadcast(None, f"BYE {username}\r\n".encode("utf-8"))
+        return remaining
+
+    def broadcast(self, sender, data):
+        # {data} is already encoded so every participant gets the same bytes
+        with self.lock:
+            recipients = [cn for u, (_, cn) in self.participants.items() if u != sender]
+        for cn in recipients:
+            cn.write(data)
+
+class SessionRegistry():
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create(self):
+        with self.lock:
+            sb_id = randint(100, 99999999)
+            while sb_id in self.sessions:
+                sb_id = randint(100, 99999999)
+            session = Session(sb_id)
+            self.sessions[sb_id] = session
+            return session
+
+    def get(self, sb_id):
+        with self.lock:
+            return self.sessions.get(sb_id)
+
+    def remove(self, sb_id):
+        with self.lock:
+            self.sessions.pop(sb_id, None)
@@ -1,25 +1,28 @@
 from pydbus import SystemBus
 from gi.repository import GLib
 import threading
-import os
+from process_local import ProcessLocal
+from switchboard.transport import SignalTransport
 
-bus = SystemBus()
-signal = bus.get('org.asamk.Signal')
+class DBusTransport(SignalTransport, ProcessLocal):
+    # calls signal-cli through a pydbus proxy instead of spawning dbus-send
+    # GDBus connections do not survive a fork, so the proxy is made on first use in the switchboard process,
+    # not when main.py builds the transport
+    def __init__(self):
+        self.signal = None
 
-class Signal(threading.Thread):
-    def __init__(self, number, sb):
-        super().__init__()
-        self.number = number
-        self.sb = sb
+    def start_process(self):
+        self.signal = SystemBus().get('org.asamk.Signal')
 
-    def send(self, message):
-        os.system(f'dbus-send --system --type=method_call --print-reply --dest="org.asamk.Signal" /org/asamk/Signal org.asamk.Signal.sendMessage string:"{message}" array:string: string:+{self.number}')
+    def proxy(self):
+        self.ensure_started()
+        return self.signal
 
-    def receive_signal(self, timestamp, source, groupID, message, attachments):
-        source = source.strip("+")
-        self.sb.send(message, source)
+    def send_message(self, number, message):
+        self.proxy().sendMessage(message, [], f"+{number}")
 
-    def run(self):
-        loop = GLib.MainLoop()
-        signal.onMessageReceived = self.receive_signal
-        loop.run()
\ No newline at end of file
+    def subscribe(self, callback):
+        def receive_signal(timestamp, source, groupID, message, attachments):
+            callback(source.strip("+"), message)
+        self.proxy().onMessageReceived = receive_signal
+        threading.Thread(target=GLib.MainLoop().run, daemon=True).start()
@@ -0,0 +1,93 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from config import Configuration
+from timer_wheel import WHEEL
+
+# picked before main.py forks, so the notification server and switchboard processes share it
+SECRET = secrets.token_bytes(32) if Configuration.sb_ticket_secret is None else Configuration.sb_ticket_secret.encode("utf-8")
+
+def new_ticket():
+    # same shape as the CKI strings real servers hand out
+    return f"{secrets.randbelow(10**8)}.{int(time.time())}.{secrets.randbelow(10**5)}"
+
+def sign(username, nickname, expires, nonce):
+    return hmac.new(SECRET, f"{username} {nickname} {expires} {nonce}".encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+def signed_ticket(username, nickname, lifetime=Configuration.sb_ticket_lifetime):
+    # an XFR ticket: the switchboard checks it with the shared secret, so the notification server hands it out
+    # without telling the switchboard first; the nickname goes last because it may contain dots
+    expires = int(time.time()) + lifetime
+    nonce = secrets.randbelow(10**8)
+    return f"{nonce}.{expires}.{sign(username, nickname, expires, nonce)}.{nickname}"
+
+def check_signed_ticket(ticket, username):
+    # returns (nickname, expires) if {ticket} was signed for {username} and has not expired, None otherwise
+    try:
+        nonce, expires, signature, nickname = ticket.split(".", 3)
+        expires = int(expires)
+    except ValueError:
+        return None
+    if expires < time.time() or not hmac.compare_digest(signature, sign(username, nickname, expires, nonce)):
+        return None
+    return nickname, expires
+
+class TicketTable():
+    # single-use switchboard tickets checked by the switchboard process; the timer wheel evicts unused ones
+    # RNG tickets are stored here when they are issued; signed XFR tickets only once they are redeemed,
+    # so the same one cannot be redeemed again while it is still valid
+    def __init__(self, lifetime=Configuration.sb_ticket_lifetime):
+        self.lifetime = lifetime
+        self.tickets = {} # ticket -> (expires, username, nickname, sb_id)
+        self.redeemed = set() # signed tickets already used
+        self.lock = threading.Lock()
+
+    def issue(self, username, nickname, sb_id=None):
+        # sb_id is None for an XFR ticket (new session) or the session an RNG invites {username} to
+        if sb_id is None:
+            return signed_ticket(username, nickname, self.lifetime)
+        ticket = new_ticket()
+        self.add(ticket, username, nickname, sb_id)
+        return ticket
+
+    def add(self, ticket, username, nickname, sb_id):
+        with self.lock:
+            self.tickets[ticket] = (time.monotonic() + self.lifetime, username, nickname, sb_id)
+        WHEEL.schedule(self.lifetime, self.discard, ticket)
+
+    def discard(self, ticket):
+        with self.lock:
+            self.tickets.pop(ticket, None)
+
+    def forget(self, ticket):
+        with self.lock:
+            self.redeemed.discard(ticket)
+
+    def redeem(self, ticket, username, sb_id=None):
+        # returns the cached nickname if {ticket} was issued to {username} for {sb_id}, None otherwise
+        if sb_id is None:
+            return self.redeem_signed(ticket, username)
+        with self.lock:
+            entry = self.tickets.pop(ticket, None)
+        if entry is None:
+            return None
+        expires, owner, nickname, session = entry
+        # the wheel only evicts to the nearest tick
+        if owner != username or session != sb_id or expires < time.monotonic():
+            return None
+        return nickname
+
+    def redeem_signed(self, ticket, username):
+        checked = check_signed_ticket(ticket, username)
+        if checked is None:
+            return None
+        nickname, expires = checked
+        with self.lock:
+            if ticket in self.redeemed:
+                return None
+            self.redeemed.add(ticket)
+        # past {expires} the signature check turns it away by itself
+        WHEEL.schedule(max(0, expires - time.time()) + 1, self.forget, ticket)
+        return nickname
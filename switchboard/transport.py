@@ -0,0 +1,122 @@
+import queue
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from config import Configuration
+from process_local import ProcessLocal
+
+class SignalTransport(ABC):
+    @abstractmethod
+    def send_message(self, number, message):
+        # delivers {message} to the Signal user +{number}; raises on failure
+        pass
+    def send_batch(self, batch):
+        # delivers [(number, message), ...] in order; returns the undelivered tail so order survives retries
+        for ix, (number, message) in enumerate(batch):
+            try:
+                self.send_message(number, message)
+            except Exception as e:
+                sys.stderr.write(f"Signal send to +{number} failed: {e}\n")
+                return batch[ix:]
+        return []
+    @abstractmethod
+    def subscribe(self, callback):
+        # starts delivering incoming messages as callback(number, message); called once per process
+        pass
+
+class MemoryTransport(SignalTransport):
+    # in-process stand-in for signal-cli, for tests and benchmarks
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+        self.callback = None
+    def send_message(self, number, message):
+        self.sent.append((number, message))
+        if self.on_send is not None:
+            self.on_send(number, message)
+    def subscribe(self, callback):
+        self.callback = callback
+    def deliver(self, number, message):
+        # simulates a message arriving from the Signal user +{number}
+        if self.callback is not None:
+            self.callback(number, message)
+
+def create_transport(kind=Configuration.signal_transport):
+    if kind == "memory":
+        return MemoryTransport()
+    # only pull in D-Bus when it is actually used
+    from switchboard.signal import DBusTransport
+    return DBusTransport()
+
+class SignalSender(ProcessLocal):
+    # bounded queue drained by one thread, so chat lines never wait on signal-cli
+    def __init__(self, transport, queue_size=Configuration.signal_queue_size, batch_size=Configuration.signal_batch_size,
+                 retries=Configuration.signal_retries, retry_delay=Configuration.signal_retry_delay):
+        self.transport = transport
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.worker = None
+
+    def start_process(self):
+        # started lazily so the thread lives in the switchboard process, not the one that built it
+        self.worker = threading.Thread(target=self.send_loop, daemon=True)
+        self.worker.start()
+
+    def send(self, number, message):
+        # returns False if the queue is full and the message was not accepted
+        self.ensure_started()
+        try:
+            self.queue.put_nowait((number, message))
+            return True
+        except queue.Full:
+            sys.stderr.write(f"Signal send queue full, dropping message to +{number}\n")
+            return False
+
+    def send_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for attempt in range(self.retries + 1):
+                batch = self.transport.send_batch(batch)
+                # no point waiting after the last attempt
+                if not batch or attempt == self.retries:
+                    break
+                time.sleep(self.retry_delay * (attempt + 1))
+            for number, _ in batch:
+                sys.stderr.write(f"Giving up on message to +{number} after {self.retries} retries\n")
+
+class SignalReceiver(ProcessLocal):
+    # one subscription per process; incoming messages are routed to sessions by sender number
+    def __init__(self, transport):
+        self.transport = transport
+        self.routes = {} # number -> sessions that include that Signal user
+        self.lock = threading.Lock()
+
+    def start_process(self):
+        self.transport.subscribe(self.dispatch)
+
+    def register(self, number, session):
+        self.ensure_started()
+        with self.lock:
+            self.routes.setdefault(number, set()).add(session)
+
+    def unregister(self, number, session):
+        with self.lock:
+            sessions = self.routes.get(number)
+            if sessions is not None:
+                sessions.discard(session)
+                if not sessions:
+                    del self.routes[number]
+
+    def dispatch(self, number, message):
+        with self.lock:
+            sessions = list(self.routes.get(number, ()))
+        for session in sessions:
+            session.receive_signal(number, message)
@@ -1,64 +1,314 @@
 import socket
 import threading
+import asyncio
+import sys
+import time
+import signal
+import multiprocessing.connection
+import metrics
+from protocol_trace import TRACER
+from timer_wheel import WHEEL
+from outbound_writer import WRITER
+from admission import ConnectionAdmission
+from collections import deque
 from config import Configuration
+from framing import CommandFramer, FramingError
 from multiprocessing import Process
 
+CONNECTIONS_ACTIVE = metrics.gauge("msn_connections_active", "Connections currently open")
+CONNECTIONS = metrics.counter("msn_connections_total", "Connections accepted")
+RECEIVED_BYTES = metrics.counter("msn_received_bytes_total", "Bytes received from clients")
+SENT_BYTES = metrics.counter("msn_sent_bytes_total", "Bytes queued for clients")
+CONNECTION_BYTES = metrics.histogram("msn_connection_bytes", "Bytes moved over one connection's lifetime", ["direction"], metrics.BYTES_BUCKETS)
+MALFORMED_COMMANDS = metrics.counter("msn_malformed_commands_total", "Connections dropped for sending input that cannot be framed")
+IDLE_TIMEOUTS = metrics.counter("msn_idle_timeouts_total", "Connections dropped for sending nothing within the idle timeout")
+DEFERRED_WRITES = metrics.counter("msn_deferred_writes_total", "Writes queued behind a full client socket buffer")
+SLOW_CONSUMERS = metrics.counter("msn_slow_consumers_total", "Times a client's outbound queue passed the high watermark")
+SLOW_CONSUMER_DISCONNECTS = metrics.counter("msn_slow_consumer_disconnects_total", "Connections dropped for letting their outbound queue overflow")
+PRESENCE_HELD_BACK = metrics.counter("msn_presence_held_back_total", "Presence updates for slow consumers that were dropped or coalesced", ["policy"])
+
 class TCPServer(Process):
 
-    def __init__(self, handler, patchers, ip=Configuration.IP_ADDR, port=Configuration.MSN_PORT, listeners=Configuration.listeners):
+    def __init__(self, handler, patchers, ip=Configuration.IP_ADDR, port=Configuration.MSN_PORT, listeners=Configuration.listeners, workers=1, metrics_port=None, idle_timeout=None):
         super().__init__()
         self.handler = handler
         self.patchers = patchers
         self.ip = ip
         self.port = port
         self.listeners = listeners
-        
+        self.workers = workers
+        self.metrics_port = metrics_port
+        self.idle_timeout = idle_timeout
+        self.admission = ConnectionAdmission()
+
     def run(self):
+        # turn SIGTERM into an exception so every process unwinds: the supervisor takes its workers down
+        # and each worker runs its stop hooks; forked workers inherit the handler
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if self.workers > 1:
+            self.supervise()
+        else:
+            self.run_worker()
+
+    def supervise(self):
+        # each worker binds the same port with SO_REUSEPORT and the kernel spreads connections between them
+        workers = [self.spawn(ix) for ix in range(self.workers)]
+        try:
+            while True:
+                multiprocessing.connection.wait([w.sentinel for w in workers])
+                for ix, w in enumerate(workers):
+                    if not w.is_alive():
+                        sys.stderr.write(f"{self.port}: worker {w.pid} exited with {w.exitcode}, restarting\n")
+                        time.sleep(Configuration.worker_restart_delay)
+                        workers[ix] = self.spawn(ix)
+        finally:
+            for w in workers:
+                w.terminate()
+
+    def spawn(self, index):
+        worker = Process(target=self.run_worker, args=[index], daemon=True)
+        worker.start()
+        return worker
+
+    def serve_metrics(self, index):
+        # each worker has its own counters, so each one gets its own endpoint
+        metrics.REGISTRY.reset()
+        if self.metrics_port is not None:
+            metrics.serve(Configuration.metrics_ip, self.metrics_port + index)
+
+    def start_worker(self, index):
+        # patcher factories that keep per-process state set it up here
+        for patcher in self.patchers:
+            if hasattr(patcher, "start"):
+                patcher.start()
+        self.serve_metrics(index)
+        TRACER.ensure_started()
+        TRACER.install_dump_signal()
+
+    def stop_worker(self):
+        # and tear it down when the process exits, e.g. the database owner flushes, syncs and closes its journal
+        for patcher in self.patchers:
+            if hasattr(patcher, "stop"):
+                patcher.stop()
+
+    def run_worker(self, index=0):
+        self.start_worker(index)
+        try:
+            self.work(index)
+        finally:
+            self.stop_worker()
+
+    def work(self, index=0):
         _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.workers > 1:
+            _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         _sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         _sock.bind((self.ip, self.port))
         _sock.listen(self.listeners)
-        connections = []
         try:
             while True:
                 connection, client_address = _sock.accept()
-                t = threading.Thread(target=Connection, args=[self.handler, self.patchers, connection, client_address])
+                # refused before a thread is started, so a connection storm cannot stall the accept loop
+                if not self.admission.admit(client_address[0]):
+                    connection.close()
+                    continue
+                # daemon threads: open connections are dropped with the process rather than holding up its exit
+                t = threading.Thread(target=self.serve, args=[connection, client_address], daemon=True)
                 t.start()
-                connections.append(t)
         finally:
             if _sock:
                 _sock.close()
-            for t in connections:
-                t.join()
+
+    def serve(self, connection, client_address):
+        try:
+            Connection(self.handler, self.patchers, connection, client_address, self.idle_timeout).recv_loop()
+        finally:
+            self.admission.release(client_address[0])
+
+class AsyncTCPServer(TCPServer):
+    # one event loop drives every connection instead of one thread per socket
+
+    def work(self, index=0):
+        asyncio.run(self.serve_forever())
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.serve_async, self.ip, self.port, backlog=self.listeners, reuse_address=True, reuse_port=self.workers > 1)
+        # SIGTERM is taken over by the loop, so it stops between callbacks rather than in the middle of one
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+        async with server:
+            await stopped
+
+    async def serve_async(self, reader, writer):
+        address = writer.get_extra_info('peername')[0]
+        if not self.admission.admit(address):
+            writer.transport.abort()
+            return
+        try:
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = AsyncConnection(self.handler, self.patchers, reader, writer, self.idle_timeout)
+            await connection.recv_loop()
+        except asyncio.CancelledError:
+            # the loop is shutting down
+            pass
+        finally:
+            self.admission.release(address)
 
 class Connection():
-    def __init__(self, handler, patchers, connection, client_address):
+    def __init__(self, handler, patchers, connection, client_address, idle_timeout=None):
         self.connection = connection
         self.client_address = client_address
         self.handler = handler()
         self.patchers = []
         self.username = None
         self.status = "FLN"
+        self.protocol = None # MSNP version chosen by VER
+        self.framer = CommandFramer()
+        self.corked = []
+        self.cork_depth = 0
+        self.cork_thread = None
+        self.shutdown_pending = False # a handler asked for a shutdown; it happens once its replies are sent
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.port = None
+        self.sampled = TRACER.sample_connection()
+        self.idle_timeout = idle_timeout
+        self.last_active = time.monotonic()
+        self.idle_timer = None
+        # writes that did not fit in the socket buffer, drained in order by the outbound writer
+        # the queue, the event and the dict are only created for a client that falls behind
+        self.outbound = None
+        self.queued = 0
+        self.out_lock = threading.RLock()
+        self.writer_registered = False
+        self.congested = False # between the high and low watermarks
+        self.writable = None # event the receive loop waits on while congested
+        self.coalesced = None # username -> latest presence line held back while congested
+        self.closing = False
+        if idle_timeout is not None:
+            self.idle_timer = WHEEL.schedule(idle_timeout, self.check_idle)
+        CONNECTIONS.inc()
+        CONNECTIONS_ACTIVE.inc()
         for patcher in patchers:
             self.add_patcher(patcher)
-        self.recv_loop()
-        
+        if TRACER.wants(self):
+            TRACER.record(self, "open", "")
+
     def recv_loop(self):
-        while True:
-            data = self.connection.recv(1024)
-            if data:
-                decoded = data.decode("utf-8")
-                if Configuration.debug:
-                    print(f"{self.get_address()[1]}: received '{decoded.strip('\r\n')}' from {self.client_address}")
-                self.handler.handle(decoded)
-            else:
-                self.connection.close()
-                return
+        try:
+            while True:
+                # a client that is not reading its replies gets no more commands read until it catches up
+                writable = self.writable
+                if writable is not None:
+                    writable.wait()
+                data = self.connection.recv(1024)
+                if not data:
+                    return
+                self.received(data)
+        except OSError:
+            return
+        finally:
+            self.stop_writing()
+            self.connection.close()
+            self.closed()
+
+    def received(self, data):
+        # the idle timer reads this when it fires instead of being rescheduled on every segment
+        self.last_active = time.monotonic()
+        self.bytes_in += len(data)
+        RECEIVED_BYTES.inc(len(data))
+        # everything the handlers send in reply to one segment leaves in a single write
+        if self.closing:
+            return
+        self.cork()
+        try:
+            for command in self.framer.feed(data):
+                if self.shutdown_pending:
+                    break
+                if TRACER.wants(self):
+                    TRACER.record(self, "recv", command)
+                self.handler.handle(command)
+        except FramingError as e:
+            MALFORMED_COMMANDS.inc()
+            if TRACER.wants(self):
+                TRACER.record(self, "malformed", str(e))
+            # nothing after this point can be framed, so the connection is dropped
+            self.stop_writing()
+            self.shutdown()
+        finally:
+            self.uncork()
+
+    def cork(self):
+        # only writes from the corking thread are held back; relays from other threads go straight out
+        if self.cork_depth == 0:
+            self.cork_thread = threading.get_ident()
+        self.cork_depth += 1
+
+    def uncork(self):
+        self.cork_depth -= 1
+        if self.cork_depth == 0:
+            self.cork_thread = None
+            if self.corked:
+                data = b"".join(self.corked)
+                self.corked.clear()
+                self.transmit(data)
+            if self.shutdown_pending:
+                self.shutdown_pending = False
+                self.shutdown()
+
+    def check_idle(self):
+        # runs on the timer wheel thread
+        idle = time.monotonic() - self.last_active
+        if idle < self.idle_timeout:
+            if self.idle_timer is not None:
+                self.idle_timer = WHEEL.schedule(self.idle_timeout - idle, self.check_idle)
+            return
+        IDLE_TIMEOUTS.inc()
+        if TRACER.wants(self):
+            TRACER.record(self, "idle", f"{idle:.0f}s")
+        # the receive loop sees the shutdown and closes the connection, which takes the user offline
+        self.stop_writing()
+        self.shutdown()
+
+    def shutdown(self):
+        # a handler's error reply (e.g. 911 before the connection is dropped) still leaves with the rest
+        if self.cork_thread == threading.get_ident():
+            self.shutdown_pending = True
+            return
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def abort(self):
+        # for a client that is not reading; its queued output is discarded, not flushed
+        self.shutdown()
+
+    def closed(self):
+        timer, self.idle_timer = self.idle_timer, None
+        if timer is not None:
+            WHEEL.cancel(timer)
+        if TRACER.wants(self):
+            TRACER.record(self, "close", "")
+        CONNECTIONS_ACTIVE.dec()
+        CONNECTION_BYTES.labels("in").observe(self.bytes_in)
+        CONNECTION_BYTES.labels("out").observe(self.bytes_out)
+        for p in self.patchers:
+            p.close()
 
     def get_address(self):
         return self.connection.getsockname()
 
+    def local_port(self):
+        # looked up once, only for traced connections
+        if self.port is None:
+            self.port = self.get_address()[1]
+        return self.port
+
     def add_patcher(self, patcher):
         p = patcher(self)
         self.patchers.append(p)
@@ -67,16 +317,212 @@ class Connection():
     def tell(self, cmd):
         self.handler.handle(cmd)
 
+    def write(self, data):
+        self.bytes_out += len(data)
+        SENT_BYTES.inc(len(data))
+        if TRACER.wants(self):
+            TRACER.record(self, "send", data)
+        if self.cork_thread == threading.get_ident():
+            self.corked.append(data)
+        else:
+            self.transmit(data)
+
+    def transmit(self, data):
+        # sends what the socket takes without blocking and queues the rest, so no caller waits on a slow client
+        with self.out_lock:
+            if self.closing:
+                return
+            if not self.outbound:
+                try:
+                    sent = self.connection.send(data, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    return # the receive loop notices and closes
+                if sent == len(data):
+                    return
+                data = data[sent:]
+                if not self.writer_registered:
+                    self.writer_registered = True
+                    WRITER.add(self)
+                if self.outbound is None:
+                    self.outbound = deque()
+            self.outbound.append(data)
+            self.queued += len(data)
+            DEFERRED_WRITES.inc()
+            self.check_watermarks(self.queued)
+
+    def flush_outbound(self):
+        # runs on the outbound writer thread when the socket can take more; returns True once the queue is empty
+        with self.out_lock:
+            while self.outbound and not self.closing:
+                chunk = self.outbound[0]
+                try:
+                    sent = self.connection.send(chunk, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    # let the receive loop run into the same error and close
+                    self.outbound.clear()
+                    self.queued = 0
+                    self.release_reader()
+                    break
+                self.queued -= sent
+                if sent < len(chunk):
+                    self.outbound[0] = chunk[sent:]
+                    break
+                self.outbound.popleft()
+                if self.congested and self.queued <= Configuration.outbound_low_watermark:
+                    data = self.caught_up()
+                    if data:
+                        self.outbound.append(data)
+                        self.queued += len(data)
+            if self.outbound and not self.closing:
+                return False
+            self.writer_registered = False
+            return True
+
+    def check_watermarks(self, queued):
+        # called with the queue length after every deferred write
+        policy = Configuration.slow_consumer_policy
+        if queued > Configuration.outbound_limit or (queued > Configuration.outbound_high_watermark and policy == "disconnect"):
+            SLOW_CONSUMER_DISCONNECTS.inc()
+            if TRACER.wants(self):
+                TRACER.record(self, "slow", f"{queued} bytes queued")
+            self.stop_writing()
+            self.abort()
+        elif queued > Configuration.outbound_high_watermark and not self.congested:
+            SLOW_CONSUMERS.inc()
+            self.congested = True
+            self.writable = threading.Event()
+
+    def caught_up(self):
+        # below the low watermark again; returns the coalesced presence lines to send, if any
+        with self.out_lock:
+            self.congested = False
+            self.release_reader()
+            lines = list(self.coalesced.values()) if self.coalesced else []
+            self.coalesced = None
+        if not lines:
+            return None
+        return "".join([f"{k}\r\n" for k in lines]).encode("utf-8")
+
+    def release_reader(self):
+        writable, self.writable = self.writable, None
+        if writable is not None:
+            writable.set()
+
+    def stop_writing(self):
+        # drops whatever is still queued; nothing is written after this
+        with self.out_lock:
+            self.closing = True
+            self.release_reader()
+            self.outbound = None
+            self.queued = 0
+            self.coalesced = None
+            if self.writer_registered:
+                self.writer_registered = False
+                WRITER.remove(self)
+
     def send(self, string):
-        self.connection.sendall(f"{string}\r\n".encode("utf-8"))
-        if Configuration.debug:
-            print(f"{self.get_address()[1]}: sent '{string}' to {self.client_address}")
+        self.write(f"{string}\r\n".encode("utf-8"))
 
     def error(self, errno, trid):
         self.send(f"{errno} {trid}")
-    
+
     def send_multi_line(self, strings):
         concat_string = "".join([f"{k}\r\n" for k in strings])
-        self.connection.sendall(concat_string.encode("utf-8"))
-        if Configuration.debug:
-            print(f"{self.get_address()[1]}: sent '{concat_string}' to {self.client_address}")
+        self.write(concat_string.encode("utf-8"))
+
+    def send_presence(self, updates):
+        # updates is {username: NLN/FLN line}; these are the only writes a slow consumer can lose
+        with self.out_lock:
+            if self.congested and not self.closing:
+                policy = Configuration.slow_consumer_policy
+                PRESENCE_HELD_BACK.labels(policy).inc(len(updates))
+                if policy == "coalesce":
+                    # only the latest status of each contact is sent once the client catches up
+                    if self.coalesced is None:
+                        self.coalesced = {}
+                    self.coalesced.update(updates)
+                return
+        self.send_multi_line(updates.values())
+
+class AsyncConnection(Connection):
+    # the StreamWriter stands in for the socket; handlers still run synchronously on the loop
+    def __init__(self, handler, patchers, reader, writer, idle_timeout=None):
+        self.reader = reader
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        super().__init__(handler, patchers, writer, writer.get_extra_info('peername'), idle_timeout)
+        # the transport is the outbound queue here; drain() waits for it to fall back to the low watermark
+        writer.transport.set_write_buffer_limits(high=Configuration.outbound_high_watermark, low=Configuration.outbound_low_watermark)
+
+    async def recv_loop(self):
+        exiting = False
+        try:
+            while True:
+                if self.congested:
+                    await self.connection.drain()
+                data = await self.reader.read(1024)
+                if not data:
+                    return
+                self.received(data)
+                # read() does not yield while input is buffered; let other connections in between segments
+                await asyncio.sleep(0)
+        except ConnectionError:
+            return
+        except asyncio.CancelledError:
+            # the process is exiting; as with the threaded server's daemon threads, the connection is just dropped
+            # without telling the other processes, which are going down too
+            exiting = True
+            raise
+        finally:
+            self.stop_writing()
+            if exiting:
+                self.connection.transport.abort()
+            else:
+                self.connection.close()
+                self.closed()
+
+    def get_address(self):
+        return self.connection.get_extra_info('sockname')
+
+    def shutdown(self):
+        # closing the transport ends the pending read on the loop
+        if self.cork_thread == threading.get_ident():
+            self.shutdown_pending = True
+            return
+        self.loop.call_soon_threadsafe(self.connection.close)
+
+    def abort(self):
+        self.loop.call_soon_threadsafe(self.connection.transport.abort)
+
+    def transmit(self, data):
+        # other threads (e.g. the Signal main loop) must hand writes over to the event loop
+        if threading.get_ident() == self.loop_thread:
+            self.transmit_on_loop(data)
+        else:
+            self.loop.call_soon_threadsafe(self.transmit_on_loop, data)
+
+    def transmit_on_loop(self, data):
+        # on shutdown the transports are closed before their receive loops get to stop_writing()
+        if self.closing or self.connection.is_closing():
+            return
+        self.connection.write(data)
+        queued = self.connection.transport.get_write_buffer_size()
+        if queued:
+            DEFERRED_WRITES.inc()
+        congested = self.congested
+        self.check_watermarks(queued)
+        if self.congested and not congested:
+            self.loop.create_task(self.wait_drained())
+
+    async def wait_drained(self):
+        try:
+            await self.connection.drain()
+        except ConnectionError:
+            return
+        data = self.caught_up()
+        if data and not self.closing:
+            self.transmit_on_loop(data)
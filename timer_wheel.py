@@ -0,0 +1,95 @@
+import sys
+import threading
+import time
+from config import Configuration
+from process_local import ProcessLocal
+
+# hierarchical timing wheel shared by everything in a process that needs a timeout
+# level n has {slots} buckets of tick * slots**n seconds; a timer sits in the lowest level its delay fits in
+# and drops a level each time the level below wraps, so scheduling, cancelling and each tick are O(1)
+# regardless of how many timers are pending
+
+class Timer():
+    __slots__ = ('expires', 'callback', 'args', 'bucket')
+    def __init__(self, expires, callback, args):
+        self.expires = expires # in ticks
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+class TimerWheel(ProcessLocal):
+    def __init__(self, tick=Configuration.timer_tick, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots ** level for level in range(levels + 1)] # ticks covered by one bucket of each level
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)] # bucket: timer -> None
+        self.now = 0 # ticks since the wheel started
+        self.started = None
+        self.lock = threading.Lock()
+
+    def start_process(self):
+        # one driver thread per process; timers inherited through fork belong to the parent
+        self.wheels = [[{} for _ in range(self.slots)] for _ in range(self.levels)]
+        self.now = 0
+        self.started = time.monotonic()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, delay, callback, *args):
+        # calls callback(*args) from the wheel thread after about {delay} seconds; returns a Timer to cancel
+        self.ensure_started()
+        with self.lock:
+            timer = Timer(self.now + max(1, round(delay / self.tick)), callback, args)
+            self.place(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.bucket is not None:
+                del timer.bucket[timer]
+                timer.bucket = None
+
+    def place(self, timer):
+        delta = timer.expires - self.now
+        for level in range(self.levels):
+            if delta < self.spans[level + 1]:
+                break
+        # beyond the top level a timer waits in its last bucket and is placed again when that comes round
+        expires = min(timer.expires, self.now + self.spans[self.levels] - 1)
+        timer.bucket = self.wheels[level][(expires // self.spans[level]) % self.slots]
+        timer.bucket[timer] = None
+
+    def advance(self):
+        # moves the wheel on by one tick and returns the timers that are due
+        self.now += 1
+        for level in range(1, self.levels):
+            if self.now % self.spans[level] != 0:
+                break
+            # the level below has wrapped: spread this level's current bucket over the lower levels
+            bucket = self.wheels[level][(self.now // self.spans[level]) % self.slots]
+            cascading = list(bucket)
+            bucket.clear()
+            for timer in cascading:
+                self.place(timer)
+        bucket = self.wheels[0][self.now % self.slots]
+        due = list(bucket)
+        bucket.clear()
+        for timer in due:
+            timer.bucket = None
+        return due
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            # catch up on every tick that has passed, even if this thread was held up
+            target = int((time.monotonic() - self.started) / self.tick)
+            while self.now < target:
+                with self.lock:
+                    due = self.advance()
+                for timer in due:
+                    try:
+                        timer.callback(*timer.args)
+                    except Exception as e:
+                        sys.stderr.write(f"Timer callback {timer.callback} failed: {e}\n")
+
+WHEEL = TimerWheel()